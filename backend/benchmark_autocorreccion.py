@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Compara la autocorrección en dos llamadas (flujo original) con la autocorrección
+integrada en la llamada principal: latencia, llamadas al modelo y error contra
+el peso real.
+
+Uso: python benchmark_autocorreccion.py [imagen[:peso_real] ...] [--repeticiones N]
+
+Sin argumentos usa las imágenes del dataset integrado que estén en disco y
+tengan peso real.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import langchain_utils_simulado as pipeline
+from image_context import ImageContext
+
+MODOS = ("dos_llamadas", "integrada")
+DATASET_DIR = os.path.join(os.path.dirname(__file__), "dataset-ninja", "integrated_cows")
+
+
+def imagenes_del_dataset():
+    """Imágenes del dataset integrado con peso real que existan en disco"""
+    with open(os.path.join(DATASET_DIR, "annotations_integrated.json"), "r", encoding="utf-8") as f:
+        images = json.load(f).get("images", [])
+    casos = []
+    for img in images:
+        ruta = os.path.join(DATASET_DIR, "images", img.get("file_name", ""))
+        if img.get("real_weight") and os.path.exists(ruta):
+            casos.append((ruta, img["real_weight"]))
+    return casos
+
+
+def parsear_casos(argumentos):
+    casos = []
+    for argumento in argumentos:
+        ruta, _, peso = argumento.partition(":")
+        casos.append((ruta, float(peso) if peso else None))
+    return casos
+
+
+class ContadorLlamadas:
+    """Cuenta las llamadas al modelo (principal + autocorrección)"""
+
+    def __init__(self):
+        self.llamadas = 0
+        self._llamar_modelo = pipeline._llamar_modelo_async
+        self._autocorregir = pipeline.autocorregir_prediccion_openai_async
+
+    def instalar(self):
+        async def llamar_modelo(*args, **kwargs):
+            self.llamadas += 1
+            return await self._llamar_modelo(*args, **kwargs)
+
+        async def autocorregir(*args, **kwargs):
+            self.llamadas += 1
+            return await self._autocorregir(*args, **kwargs)
+
+        pipeline._llamar_modelo_async = llamar_modelo
+        pipeline.autocorregir_prediccion_openai_async = autocorregir
+
+
+async def medir(casos, repeticiones, contador):
+    filas = []
+    for ruta, peso_real in casos:
+        ctx = ImageContext.from_path(ruta)
+        for _ in range(repeticiones):
+            llamadas_antes = contador.llamadas
+            inicio = time.perf_counter()
+            resultado = await pipeline.combine_openai_and_dataset_analysis_async(ctx)
+            latencia = (time.perf_counter() - inicio) * 1000
+            peso = resultado.get("peso") if resultado else None
+            filas.append({
+                "imagen": ruta,
+                "peso": peso,
+                "peso_real": peso_real,
+                "latencia_ms": latencia,
+                "llamadas": contador.llamadas - llamadas_antes,
+            })
+    return filas
+
+
+def resumir(filas):
+    latencias = [f["latencia_ms"] for f in filas]
+    errores = [abs(f["peso"] - f["peso_real"]) for f in filas if f["peso"] and f["peso_real"]]
+    return {
+        "ejecuciones": len(filas),
+        "latencia_media_ms": sum(latencias) / len(latencias) if latencias else 0,
+        "llamadas_promedio": sum(f["llamadas"] for f in filas) / len(filas) if filas else 0,
+        "mae_kg": sum(errores) / len(errores) if errores else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("imagenes", nargs="*")
+    parser.add_argument("--repeticiones", type=int, default=1)
+    args = parser.parse_args()
+
+    casos = parsear_casos(args.imagenes) if args.imagenes else imagenes_del_dataset()
+    if not casos:
+        casos = [("test_cow.jpg", None)]
+        print("⚠️ No hay imágenes del dataset en disco, usando test_cow.jpg (sin peso real)")
+
+    contador = ContadorLlamadas()
+    contador.instalar()
+
+    resumenes = {}
+    for modo in MODOS:
+        pipeline.AUTOCORRECCION_CONFIG["modo"] = modo
+        print(f"\n⚙️ Autocorrección: {modo}")
+        resumenes[modo] = resumir(asyncio.run(medir(casos, args.repeticiones, contador)))
+
+    print("\n" + "=" * 80)
+    print(f"{'modo':<15} {'ejecuciones':>11} {'latencia media ms':>18} {'llamadas/análisis':>18} {'MAE kg':>8}")
+    print("=" * 80)
+    for modo, r in resumenes.items():
+        mae = f"{r['mae_kg']:.1f}" if r["mae_kg"] is not None else "-"
+        print(f"{modo:<15} {r['ejecuciones']:>11} {r['latencia_media_ms']:>18.0f} {r['llamadas_promedio']:>18.2f} {mae:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Compara configuraciones de preprocesamiento de imagen (lado máximo, calidad
+JPEG y nivel de detalle): bytes enviados, latencia del modelo y peso estimado.
+
+Uso: python benchmark_preprocesamiento.py [imagen ...] [--repeticiones N]
+"""
+
+import argparse
+import asyncio
+import time
+
+import langchain_utils_simulado as pipeline
+from image_context import ImageContext
+
+# (max_lado, calidad_jpeg, detalle); 0 = sin cambios
+CONFIGURACIONES = [
+    (0, 0, "auto"),
+    (2048, 90, "high"),
+    (1024, 85, "auto"),
+    (768, 80, "auto"),
+    (512, 75, "low"),
+]
+
+
+async def medir(ctx, repeticiones):
+    """Ejecuta el análisis varias veces con la configuración vigente"""
+    pesos = []
+    latencias = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        respuesta = await pipeline.analyze_cow_image_with_context_async(ctx)
+        latencias.append((time.perf_counter() - inicio) * 1000)
+        resultado = pipeline.extract_json_from_response(respuesta) if respuesta else None
+        if resultado and resultado.get("peso"):
+            pesos.append(resultado["peso"])
+    return pesos, latencias
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("imagenes", nargs="*", default=["test_cow.jpg"])
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    contextos = [ImageContext.from_path(ruta) for ruta in args.imagenes]
+    filas = []
+
+    for max_lado, calidad, detalle in CONFIGURACIONES:
+        pipeline.IMAGE_PREPROCESS_CONFIG.update(max_lado=max_lado, calidad_jpeg=calidad, detalle=detalle)
+        etiqueta = pipeline.etiqueta_preprocesamiento()
+        print(f"\n⚙️ Configuración {etiqueta}")
+
+        for ctx in contextos:
+            _, bytes_enviados = ctx.para_modelo(max_lado, calidad)
+            pesos, latencias = asyncio.run(medir(ctx, args.repeticiones))
+            filas.append((etiqueta, str(ctx), ctx.size_bytes, bytes_enviados, latencias, pesos))
+
+    print("\n" + "=" * 100)
+    print(f"{'configuración':<24} {'imagen':<20} {'bytes orig':>11} {'enviados':>10} {'ahorro':>7} {'lat. media ms':>14} {'pesos kg'}")
+    print("=" * 100)
+    for etiqueta, imagen, originales, enviados, latencias, pesos in filas:
+        ahorro = 100 * (originales - enviados) / originales
+        latencia = sum(latencias) / len(latencias)
+        print(f"{etiqueta:<24} {imagen[-20:]:<20} {originales:>11} {enviados:>10} {ahorro:>6.1f}% {latencia:>14.0f} {pesos}")
+
+    print("\n📊 Métricas acumuladas por configuración:")
+    for etiqueta, metricas in pipeline.METRICAS_PREPROCESAMIENTO.resumen().items():
+        print(f"   {etiqueta}: {metricas}")
+
+
+if __name__ == "__main__":
+    main()
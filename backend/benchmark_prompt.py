@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Compara las versiones del prompt (prompt_templates.PROMPT_VERSIONES): latencia
+del modelo, tokens de entrada/salida, tokens servidos desde la caché de
+prefijos del proveedor y error contra el peso real.
+
+Uso: python benchmark_prompt.py [imagen[:peso_real] ...] [--repeticiones N] [--versiones v1,v2]
+
+Sin argumentos usa las imágenes del dataset integrado que estén en disco y
+tengan peso real.
+"""
+
+import argparse
+import asyncio
+
+import langchain_utils_simulado as pipeline
+from benchmark_autocorreccion import imagenes_del_dataset, parsear_casos
+from image_context import ImageContext
+from prompt_templates import PROMPT_VERSIONES
+
+
+async def medir(casos, repeticiones):
+    errores = []
+    for ruta, peso_real in casos:
+        ctx = ImageContext.from_path(ruta)
+        for _ in range(repeticiones):
+            respuesta = await pipeline.analyze_cow_image_with_context_async(ctx)
+            datos = pipeline.extract_json_from_response(respuesta) if respuesta else None
+            if datos and datos.get("peso") and peso_real:
+                errores.append(abs(float(datos["peso"]) - peso_real))
+    return sum(errores) / len(errores) if errores else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("imagenes", nargs="*")
+    parser.add_argument("--repeticiones", type=int, default=1)
+    parser.add_argument("--versiones", default=",".join(PROMPT_VERSIONES))
+    args = parser.parse_args()
+
+    casos = parsear_casos(args.imagenes) if args.imagenes else imagenes_del_dataset()
+    if not casos:
+        casos = [("test_cow.jpg", None)]
+        print("⚠️ No hay imágenes del dataset en disco, usando test_cow.jpg (sin peso real)")
+
+    maes = {}
+    for version in args.versiones.split(","):
+        pipeline.PROMPT_CONFIG["version"] = version
+        print(f"\n📝 Prompt: {version}")
+        maes[version] = asyncio.run(medir(casos, args.repeticiones))
+
+    metricas = pipeline.METRICAS_PROMPT.resumen()
+    print("\n" + "=" * 100)
+    print(f"{'versión':<14} {'llamadas':>8} {'latencia p50 ms':>16} {'tokens entrada':>15} {'cacheados':>10} {'tokens salida':>14} {'MAE kg':>8}")
+    print("=" * 100)
+    for version, mae in maes.items():
+        m = metricas.get(version, {})
+        latencia = m.get("latencia_ms", {}).get("p50", 0)
+        mae_txt = f"{mae:.1f}" if mae is not None else "-"
+        print(f"{version:<14} {m.get('n', 0):>8} {latencia:>16.0f} {m.get('tokens_entrada_promedio', 0):>15.0f} "
+              f"{m.get('tokens_cacheados_promedio', 0):>10.0f} {m.get('tokens_salida_promedio', 0):>14.0f} {mae_txt:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Circuit breaker de la etapa del modelo.
+
+Lleva una ventana móvil con el resultado y la latencia de las últimas llamadas
+al modelo. Si la tasa de errores o de llamadas lentas supera el umbral, el
+circuito se abre y las peticiones pasan directo a la estimación solo por
+dataset (modo degradado) en lugar de esperar su timeout. Pasado un tiempo
+deja pasar una llamada de prueba (semiabierto): si sale bien se cierra.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+# Configuración del circuit breaker
+CIRCUITO_CONFIG = {
+    'ventana_segundos': float(os.getenv("CIRCUITO_VENTANA_SEGUNDOS", "60")),
+    'min_llamadas': int(os.getenv("CIRCUITO_MIN_LLAMADAS", "5")),
+    'umbral_error_pct': float(os.getenv("CIRCUITO_UMBRAL_ERROR_PCT", "50")),
+    'lenta_segundos': float(os.getenv("CIRCUITO_LENTA_SEGUNDOS", "60")),
+    'umbral_lentas_pct': float(os.getenv("CIRCUITO_UMBRAL_LENTAS_PCT", "80")),
+    'abierto_segundos': float(os.getenv("CIRCUITO_ABIERTO_SEGUNDOS", "30")),
+}
+
+CERRADO = "cerrado"
+ABIERTO = "abierto"
+SEMIABIERTO = "semiabierto"
+
+
+class CircuitoAbiertoError(Exception):
+    """El circuito del modelo está abierto: no se hacen llamadas"""
+
+
+class CircuitBreaker:
+    """Circuit breaker por tasa de errores y de llamadas lentas en una ventana de tiempo"""
+
+    def __init__(self, nombre: str, config: dict = None):
+        self.nombre = nombre
+        self.config = config or CIRCUITO_CONFIG
+        self._lock = threading.Lock()
+        self._llamadas = deque()  # (timestamp, exito, latencia)
+        self._estado = CERRADO
+        self._abierto_desde = 0.0
+        self._sonda_en_curso = False
+        self.aperturas = 0
+        self.rechazadas = 0
+        self.motivo = None
+
+    def _actualizar_estado(self, ahora):
+        """Abierto -> semiabierto cuando pasa el tiempo de espera (llamar con el lock tomado)"""
+        if self._estado == ABIERTO and ahora - self._abierto_desde >= self.config['abierto_segundos']:
+            self._estado = SEMIABIERTO
+            self._sonda_en_curso = False
+
+    def estado(self) -> str:
+        with self._lock:
+            self._actualizar_estado(time.monotonic())
+            return self._estado
+
+    def admitir(self) -> bool:
+        """Autoriza una llamada; devuelve True si es la llamada de prueba del estado semiabierto
+
+        Lanza CircuitoAbiertoError si el circuito no deja pasar la llamada.
+        """
+        with self._lock:
+            self._actualizar_estado(time.monotonic())
+            if self._estado == CERRADO:
+                return False
+            if self._estado == SEMIABIERTO and not self._sonda_en_curso:
+                self._sonda_en_curso = True
+                return True
+            self.rechazadas += 1
+        raise CircuitoAbiertoError(f"Circuito '{self.nombre}' {self._estado}: {self.motivo}")
+
+    def liberar_sonda(self):
+        """La llamada de prueba terminó sin resultado (cancelada o rechazada antes de salir)"""
+        with self._lock:
+            self._sonda_en_curso = False
+
+    def registrar(self, exito: bool, latencia: float, es_sonda: bool = False):
+        """Registra una llamada terminada y abre o cierra el circuito según corresponda
+
+        `es_sonda` es lo que devolvió `admitir()` para esa llamada: en estado
+        semiabierto solo la llamada de prueba decide si el circuito se cierra.
+        """
+        ahora = time.monotonic()
+        lenta = latencia >= self.config['lenta_segundos']
+        with self._lock:
+            if self._estado == SEMIABIERTO:
+                if not es_sonda:
+                    # Llamada admitida antes de abrirse el circuito que termina tarde: no cuenta
+                    return
+                if exito and not lenta:
+                    print(f"✅ Circuito '{self.nombre}' cerrado: la llamada de prueba respondió en {latencia:.1f}s")
+                    self._estado = CERRADO
+                    self._llamadas.clear()
+                    self.motivo = None
+                else:
+                    self._abrir(ahora, "falló la llamada de prueba")
+                self._sonda_en_curso = False
+                return
+
+            self._llamadas.append((ahora, exito, latencia))
+            limite = ahora - self.config['ventana_segundos']
+            while self._llamadas and self._llamadas[0][0] < limite:
+                self._llamadas.popleft()
+
+            if self._estado != CERRADO or len(self._llamadas) < self.config['min_llamadas']:
+                return
+            total = len(self._llamadas)
+            errores_pct = sum(1 for _, ok, _ in self._llamadas if not ok) / total * 100
+            lentas_pct = sum(1 for _, _, lat in self._llamadas if lat >= self.config['lenta_segundos']) / total * 100
+            if errores_pct >= self.config['umbral_error_pct']:
+                self._abrir(ahora, f"{errores_pct:.0f}% de errores en {total} llamadas")
+            elif lentas_pct >= self.config['umbral_lentas_pct']:
+                self._abrir(ahora, f"{lentas_pct:.0f}% de llamadas de más de {self.config['lenta_segundos']:.0f}s")
+
+    def _abrir(self, ahora, motivo):
+        self._estado = ABIERTO
+        self._abierto_desde = ahora
+        self.aperturas += 1
+        self.motivo = motivo
+        print(f"🔌 Circuito '{self.nombre}' abierto por {self.config['abierto_segundos']:.0f}s: {motivo}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            ahora = time.monotonic()
+            self._actualizar_estado(ahora)
+            total = len(self._llamadas)
+            errores = sum(1 for _, ok, _ in self._llamadas if not ok)
+            latencias = [lat for _, _, lat in self._llamadas]
+            return {
+                'estado': self._estado,
+                'motivo': self.motivo,
+                'reabre_en_segundos': (
+                    round(max(0.0, self._abierto_desde + self.config['abierto_segundos'] - ahora), 1)
+                    if self._estado == ABIERTO else None
+                ),
+                'llamadas_en_ventana': total,
+                'tasa_error': round(errores / total, 4) if total else 0.0,
+                'latencia_promedio_s': round(sum(latencias) / total, 3) if total else None,
+                'aperturas': self.aperturas,
+                'rechazadas': self.rechazadas,
+            }
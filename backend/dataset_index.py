@@ -0,0 +1,172 @@
+"""
+Índice vectorizado del dataset de referencia.
+
+Las imágenes de `annotations_integrated.json` se compilan una sola vez en
+arrays de NumPy (resoluciones, aspect ratios, pesos, matriz de medidas
+corporales) para que la estimación por similitud sea una única expresión
+vectorizada en lugar de un bucle de Python por imagen.
+"""
+
+import numpy as np
+
+# Medidas corporales que se comparan (mismo orden que las columnas de la matriz)
+MEDIDAS_CORPORALES = (
+    'heart_girth_cm',
+    'oblique_length_cm',
+    'withers_height_cm',
+    'hip_length_cm',
+)
+
+# Vistas del animal tal como aparecen en `view_angle` del dataset
+VISTA_LATERAL = 'side'
+VISTA_TRASERA = 'back'
+
+
+def inferir_vista(aspect_ratio: float):
+    """Vista probable a partir de la orientación: una vaca de costado ocupa un encuadre
+    apaisado y una vista trasera/frontal uno vertical; cuadrada = indeterminada"""
+    if aspect_ratio > 1.1:
+        return VISTA_LATERAL
+    if aspect_ratio < 0.9:
+        return VISTA_TRASERA
+    return None
+
+
+class DatasetIndex:
+    """Arrays precalculados de las imágenes de referencia"""
+
+    def __init__(self, images: list):
+        self.total = len(images)
+
+        widths = np.array([img.get('width', 800) for img in images], dtype=np.float64)
+        heights = np.array([img.get('height', 600) for img in images], dtype=np.float64)
+        self.sizes = widths * heights
+        self.ratios = widths / heights
+
+        # Si hay peso real conocido se usa para calibración; si no, la estimación
+        self.pesos = np.array(
+            [img.get('real_weight') or img.get('weight_estimate', 400) for img in images],
+            dtype=np.float64,
+        )
+        self.tiene_medidas = np.array([bool(img.get('has_real_measurements')) for img in images], dtype=bool)
+        self.tiene_peso_real = np.array([bool(img.get('real_weight')) for img in images], dtype=bool)
+        # Vista declarada o, si falta, inferida de la orientación de la imagen
+        self.vistas = np.array(
+            [img.get('view_angle') or inferir_vista(ratio) or '' for img, ratio in zip(images, self.ratios)],
+            dtype=object,
+        )
+
+        # Matriz de medidas (NaN = medida no disponible o no positiva)
+        self.medidas = np.full((self.total, len(MEDIDAS_CORPORALES)), np.nan)
+        for i, img in enumerate(images):
+            body_measurements = img.get('body_measurements') or {}
+            for j, medida in enumerate(MEDIDAS_CORPORALES):
+                valor = body_measurements.get(medida)
+                if valor is not None and valor > 0:
+                    self.medidas[i, j] = valor
+
+    def similitudes(self, image_characteristics: dict) -> np.ndarray:
+        """Puntaje de similitud de cada imagen de referencia con la imagen de entrada"""
+        input_size = image_characteristics.get('image_size', 800*600)
+        input_ratio = image_characteristics.get('aspect_ratio', 1.33)
+
+        # Resolución similar (+2) y aspect ratio similar (+1)
+        size_diff = np.abs(self.sizes - input_size) / np.maximum(self.sizes, input_size)
+        scores = np.where(size_diff < 0.3, 2.0, 0.0)
+        scores += np.where(np.abs(self.ratios - input_ratio) < 0.2, 1.0, 0.0)
+
+        # Medidas corporales (peso alto: x3) si la entrada las trae
+        input_measurements = image_characteristics.get('body_measurements')
+        if input_measurements:
+            scores += self._similitud_medidas(input_measurements) * 3
+
+        # Priorizar imágenes con medidas reales (+2)
+        scores += np.where(self.tiene_medidas, 2.0, 0.0)
+        return scores
+
+    def _similitud_medidas(self, input_measurements: dict) -> np.ndarray:
+        """Similitud promedio de medidas corporales (0 si no hay medidas comparables)"""
+        entrada = np.array(
+            [input_measurements.get(medida, np.nan) for medida in MEDIDAS_CORPORALES],
+            dtype=np.float64,
+        )
+        comparables = ~np.isnan(self.medidas) & ~np.isnan(entrada)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            similitud = np.maximum(0.0, 1 - np.abs(self.medidas - entrada) / self.medidas)
+        similitud = np.where(comparables, similitud, 0.0)
+
+        cantidad = comparables.sum(axis=1)
+        promedio = np.divide(similitud.sum(axis=1), cantidad, out=np.zeros(self.total), where=cantidad > 0)
+        # Solo cuentan las imágenes con medidas reales
+        return np.where(self.tiene_medidas, promedio, 0.0)
+
+    def relevancia(self, image_characteristics: dict) -> np.ndarray:
+        """Puntaje para elegir referencias del prompt: similitud + misma vista + cercanía continua
+
+        Los términos continuos (diferencia relativa de resolución y de aspect ratio)
+        desempatan entre imágenes que caen en los mismos umbrales de `similitudes`.
+        """
+        scores = self.similitudes(image_characteristics)
+
+        input_size = image_characteristics.get('image_size', 800*600)
+        input_ratio = image_characteristics.get('aspect_ratio', 1.33)
+        vista = inferir_vista(input_ratio)
+        if vista is not None:
+            scores += np.where(self.vistas == vista, 2.0, 0.0)
+
+        scores += 1 - np.abs(self.sizes - input_size) / np.maximum(self.sizes, input_size)
+        scores += np.maximum(0.0, 1 - np.abs(self.ratios - input_ratio))
+        # Una referencia con peso real confirmado es mejor ancla que una estimación
+        scores += np.where(self.tiene_peso_real, 1.0, 0.0)
+        return scores
+
+    def top_k(self, image_characteristics: dict, k: int) -> list:
+        """Índices de las `k` referencias más relevantes para la imagen, de mayor a menor"""
+        if self.total == 0 or k <= 0:
+            return []
+        scores = self.relevancia(image_characteristics)
+        # Orden estable: ante empate se conserva el orden del dataset
+        return np.argsort(-scores, kind='stable')[:k].tolist()
+
+    def estimar_peso_base(self, image_characteristics: dict):
+        """Promedio de pesos ponderado por similitud: (peso_base, similitud_total) o None"""
+        if self.total == 0:
+            return None
+
+        scores = self.similitudes(image_characteristics)
+        total_similarity = float(scores.sum())
+        if total_similarity <= 0:
+            return None
+
+        peso_base = float(np.dot(self.pesos, scores) / total_similarity)
+        return peso_base, total_similarity
+
+
+class DatasetSnapshot:
+    """Versión inmutable del dataset cargado: datos, índice y contexto de prompt.
+
+    Se reemplaza entera al recargar, de modo que las peticiones en curso siguen
+    usando la instantánea que obtuvieron sin bloquearse. `lineas_referencia` tiene
+    el texto de prompt ya formateado de cada imagen, para armar el contexto de
+    las referencias elegidas sin reformatearlas en cada petición.
+    """
+
+    def __init__(self, data: dict, ruta: str, mtime: float, tamano: int, contexto_prompt: str,
+                 lineas_referencia: list = None):
+        self.data = data
+        self.images = data.get('images', [])
+        self.index = DatasetIndex(self.images)
+        self.ruta = ruta
+        self.mtime = mtime
+        self.tamano = tamano
+        self.contexto_prompt = contexto_prompt
+        self.lineas_referencia = lineas_referencia or []
+
+    def info(self) -> dict:
+        return {
+            'ruta': self.ruta,
+            'total_imagenes': self.index.total,
+            'imagenes_con_medidas': int(self.index.tiene_medidas.sum()),
+            'mtime': self.mtime,
+            'tamano_bytes': self.tamano,
+        }
@@ -0,0 +1,133 @@
+"""
+Plazo (deadline) de cada petición, propagado a todas las etapas del pipeline.
+
+El endpoint fija el instante límite con `plazo(segundos)`; como se guarda en
+una ContextVar, lo ven también las tareas del ensemble y los hilos de
+`asyncio.to_thread`. Cada etapa (descarga, codificación, dataset, llamadas al
+modelo, autocorrección) consulta el tiempo restante: si ya no alcanza, no
+empieza trabajo nuevo y el pipeline devuelve el mejor resultado parcial.
+
+En un análisis compartido (single-flight) el plazo es el más holgado de las
+peticiones que esperan y puede extenderse mientras corre; por eso las esperas
+usan `esperar_con_plazo`, que vuelve a leerlo.
+"""
+
+import asyncio
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+
+from pipeline_metrics import MetricasPorClave
+from single_flight import valor_actual
+
+# Instante límite (time.monotonic) de la petición en curso
+PLAZO_PETICION = contextvars.ContextVar("plazo_peticion", default=None)
+
+# Cada cuánto se vuelve a leer un plazo compartido mientras se espera
+RELECTURA_PLAZO_SEGUNDOS = 1.0
+
+# Veces que se agotó el plazo, por etapa
+PLAZOS_AGOTADOS = MetricasPorClave()
+
+
+class PlazoAgotadoError(Exception):
+    """Se agotó el plazo de la petición antes de terminar una etapa"""
+
+    def __init__(self, etapa: str):
+        super().__init__(f"Plazo de la petición agotado en la etapa: {etapa}")
+        self.etapa = etapa
+
+
+@contextmanager
+def plazo(segundos: float):
+    """Fija el plazo de la petición en curso (no lo extiende si ya hay uno más corto)"""
+    limite = time.monotonic() + segundos
+    actual = valor_actual(PLAZO_PETICION)
+    token = PLAZO_PETICION.set(limite if actual is None else min(actual, limite))
+    try:
+        yield
+    finally:
+        PLAZO_PETICION.reset(token)
+
+
+def plazo_mas_holgado(limites):
+    """Plazo de una ejecución compartida: el más tardío; sin plazo si alguna petición no lo tiene"""
+    if not limites or any(limite is None for limite in limites):
+        return None
+    return max(limites)
+
+
+def tiempo_restante():
+    """Segundos que le quedan a la petición, o None si no tiene plazo"""
+    limite = valor_actual(PLAZO_PETICION)
+    if limite is None:
+        return None
+    return max(0.0, limite - time.monotonic())
+
+
+def plazo_vencido() -> bool:
+    restante = tiempo_restante()
+    return restante is not None and restante <= 0
+
+
+def limitar_timeout(timeout):
+    """El menor entre `timeout` y el tiempo restante de la petición (None = sin límite)"""
+    restante = tiempo_restante()
+    if restante is None:
+        return timeout
+    return restante if timeout is None else min(timeout, restante)
+
+
+def plazo_es_compartido() -> bool:
+    return not isinstance(PLAZO_PETICION.get(), (float, type(None)))
+
+
+async def esperar_con_plazo(awaitable, timeout: float = None, gracia: float = 0.0):
+    """Como asyncio.wait_for con `timeout` acotado por el plazo de la petición (más `gracia`)
+
+    Si el plazo es compartido se vuelve a leer periódicamente: un seguidor que se
+    une con más tiempo extiende la espera. Lanza asyncio.TimeoutError al vencer.
+    """
+    tarea = asyncio.ensure_future(awaitable)
+    limite_timeout = None if timeout is None else time.monotonic() + timeout
+    try:
+        while True:
+            espera = None if limite_timeout is None else max(0.0, limite_timeout - time.monotonic())
+            restante = tiempo_restante()
+            if restante is not None:
+                espera = restante + gracia if espera is None else min(espera, restante + gracia)
+            if espera is not None and espera <= 0:
+                raise asyncio.TimeoutError()
+            if plazo_es_compartido():
+                espera = RELECTURA_PLAZO_SEGUNDOS if espera is None else min(espera, RELECTURA_PLAZO_SEGUNDOS)
+            hechas, _ = await asyncio.wait({tarea}, timeout=espera)
+            if hechas:
+                return tarea.result()
+    finally:
+        if not tarea.done():
+            tarea.cancel()
+
+
+def plazo_agotado(etapa: str) -> PlazoAgotadoError:
+    """Registra el vencimiento en la etapa y devuelve la excepción para lanzarla"""
+    print(f"⏳ Plazo de la petición agotado: {etapa}")
+    PLAZOS_AGOTADOS.registrar(etapa)
+    return PlazoAgotadoError(etapa)
+
+
+def verificar_plazo(etapa: str):
+    """Lanza PlazoAgotadoError si ya no queda tiempo para empezar la etapa"""
+    if plazo_vencido():
+        raise plazo_agotado(etapa)
+
+
+def con_plazo(segundos: float):
+    """Decorador de endpoints async: toda la petición corre con ese plazo"""
+    def decorador(endpoint):
+        @functools.wraps(endpoint)
+        async def envoltura(*args, **kwargs):
+            with plazo(segundos):
+                return await endpoint(*args, **kwargs)
+        return envoltura
+    return decorador
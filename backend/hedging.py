@@ -0,0 +1,121 @@
+"""
+Peticiones con cobertura (hedging) para recortar la cola de latencia.
+
+Si una llamada al modelo no respondió cuando ya pasó el percentil 90 de las
+latencias recientes, se envía un duplicado y se usa la primera respuesta que
+llegue; la otra se cancela. Los duplicados están limitados por un presupuesto
+(por defecto como máximo un 5% de llamadas extra).
+
+Cada llamada aporta una muestra de latencia medida desde el envío original.
+Si gana la cobertura, la muestra es lo que llevaba la original al cancelarla
+(una cota inferior de su latencia), no lo que tardó la cobertura: si no, el
+percentil bajaría con cada cobertura y se cubrirían llamadas que no son lentas.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Configuración del hedging
+HEDGING_CONFIG = {
+    'activo': os.getenv("HEDGING_ACTIVO", "0") == "1",
+    'percentil': float(os.getenv("HEDGING_PERCENTIL", "90")),
+    'presupuesto_pct': float(os.getenv("HEDGING_PRESUPUESTO_PCT", "5")),
+    'min_muestras': int(os.getenv("HEDGING_MIN_MUESTRAS", "20")),
+}
+
+
+class HedgingLLM:
+    """Envía una llamada duplicada cuando la original supera el percentil de latencia reciente"""
+
+    def __init__(self, config: dict = None, max_muestras: int = 200, ventana_presupuesto: int = 1000):
+        self.config = config or HEDGING_CONFIG
+        self._lock = threading.Lock()
+        self._max_muestras = max_muestras
+        self._latencias = {}  # clave -> deque de latencias (s)
+        self._ventana = deque(maxlen=ventana_presupuesto)  # 0 por llamada, 1 por cobertura
+        self.llamadas = 0
+        self.coberturas = 0
+        self.ganadas_por_cobertura = 0
+
+    def umbral(self, clave):
+        """Percentil de latencia de la clave, o None si todavía no hay suficientes muestras"""
+        with self._lock:
+            latencias = list(self._latencias.get(clave, ()))
+        if len(latencias) < self.config['min_muestras']:
+            return None
+        return float(np.percentile(latencias, self.config['percentil']))
+
+    def _registrar_latencia(self, clave, latencia):
+        with self._lock:
+            if clave not in self._latencias:
+                self._latencias[clave] = deque(maxlen=self._max_muestras)
+            self._latencias[clave].append(latencia)
+
+    def _usar_presupuesto(self) -> bool:
+        """True si otra cobertura entra en el presupuesto de llamadas extra (ventana móvil)"""
+        with self._lock:
+            coberturas = sum(self._ventana)
+            llamadas = len(self._ventana) - coberturas
+            if coberturas + 1 > llamadas * self.config['presupuesto_pct'] / 100:
+                return False
+            self._ventana.append(1)
+            self.coberturas += 1
+            return True
+
+    async def ejecutar(self, fabrica, clave=None):
+        """Ejecuta `await fabrica()` con una cobertura si se demora más que el percentil"""
+        with self._lock:
+            self.llamadas += 1
+            self._ventana.append(0)
+
+        inicio = time.monotonic()
+        primaria = asyncio.ensure_future(fabrica())
+        tareas = {primaria}
+        try:
+            umbral = self.umbral(clave)
+            if umbral is not None:
+                hechas, _ = await asyncio.wait(tareas, timeout=umbral)
+                if not hechas and self._usar_presupuesto():
+                    print(f"🪁 Llamada sin respuesta tras {umbral:.1f}s (p{self.config['percentil']:.0f}), enviando cobertura")
+                    cobertura = asyncio.ensure_future(fabrica())
+                    tareas.add(cobertura)
+
+            # Gana la primera que termine bien; si una falla se espera a la otra
+            while tareas:
+                hechas, tareas = await asyncio.wait(tareas, return_when=asyncio.FIRST_COMPLETED)
+                for tarea in hechas:
+                    if tarea.exception() is None:
+                        # Desde el envío original, gane la original o la cobertura
+                        self._registrar_latencia(clave, time.monotonic() - inicio)
+                        if tarea is not primaria:
+                            with self._lock:
+                                self.ganadas_por_cobertura += 1
+                        return tarea.result()
+                if not tareas:
+                    # Todas fallaron: propagar el error de la primaria
+                    return primaria.result()
+        finally:
+            for tarea in tareas:
+                tarea.cancel()
+
+    def stats(self) -> dict:
+        with self._lock:
+            claves = list(self._latencias)
+            resumen = {
+                'activo': self.config['activo'],
+                'llamadas': self.llamadas,
+                'coberturas': self.coberturas,
+                'tasa_cobertura': round(self.coberturas / self.llamadas, 4) if self.llamadas else 0.0,
+                'ganadas_por_cobertura': self.ganadas_por_cobertura,
+                'presupuesto_pct': self.config['presupuesto_pct'],
+            }
+        resumen['umbral_segundos'] = {
+            str(clave): round(umbral, 3) if umbral is not None else None
+            for clave, umbral in ((clave, self.umbral(clave)) for clave in claves)
+        }
+        return resumen
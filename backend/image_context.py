@@ -0,0 +1,160 @@
+"""
+Contexto de imagen por petición.
+
+Una imagen subida o descargada se valida y decodifica una sola vez; todas las
+etapas del pipeline (modelo de visión, dataset, autocorrección) reutilizan los
+mismos bytes, la imagen decodificada, el base64 y las estadísticas.
+"""
+
+import base64
+import hashlib
+import os
+import threading
+from io import BytesIO
+
+from PIL import Image
+
+# Tamaño máximo del lado mayor de la miniatura
+THUMBNAIL_SIZE = (512, 512)
+# Resolución sobre la que se calculan brillo y contraste
+STATS_SIZE = (512, 512)
+
+
+class ImageContext:
+    """Imagen de una petición, decodificada una sola vez y compartida por todas las etapas"""
+
+    def __init__(self, raw_bytes: bytes, source: str = None):
+        if not raw_bytes:
+            raise ValueError("La imagen está vacía")
+
+        self.raw_bytes = raw_bytes
+        self.source = source  # Ruta, URL o nombre de archivo (solo informativo)
+        self.sha256 = hashlib.sha256(raw_bytes).hexdigest()
+
+        # Validar la imagen y leer la cabecera (no decodifica los píxeles)
+        with Image.open(BytesIO(raw_bytes)) as img:
+            self.format = img.format
+            self.width, self.height = img.size
+            img.verify()
+
+        self._lock = threading.RLock()
+        self._image = None
+        self._thumbnail = None
+        self._base64 = None
+        self._stats = None
+        self._para_modelo = {}  # (max_lado, calidad) -> (base64, bytes enviados)
+
+    @classmethod
+    def from_path(cls, image_path: str) -> "ImageContext":
+        """Crea el contexto leyendo un archivo local"""
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"El archivo {image_path} no existe")
+        with open(image_path, "rb") as image_file:
+            return cls(image_file.read(), source=image_path)
+
+    def __str__(self):
+        return self.source or f"imagen {self.sha256[:12]}"
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.raw_bytes)
+
+    @property
+    def image(self) -> Image.Image:
+        """Imagen decodificada (se decodifica en el primer acceso)"""
+        if self._image is None:
+            with self._lock:
+                if self._image is None:
+                    img = Image.open(BytesIO(self.raw_bytes))
+                    img.load()
+                    self._image = img
+        return self._image
+
+    def _decodificar_reducida(self, tamano) -> Image.Image:
+        """Decodifica directamente a baja resolución, sin pasar por la imagen completa
+
+        En JPEG, thumbnail() activa el modo draft y el decodificador escala por
+        1/2, 1/4 u 1/8 mientras decodifica; la memoria queda acotada por
+        `tamano` y no por los megapíxeles de la foto.
+        """
+        img = Image.open(BytesIO(self.raw_bytes))
+        img.thumbnail(tamano)
+        return img
+
+    @property
+    def thumbnail(self) -> Image.Image:
+        """Miniatura RGB para análisis livianos"""
+        if self._thumbnail is None:
+            with self._lock:
+                if self._thumbnail is None:
+                    self._thumbnail = self._decodificar_reducida(THUMBNAIL_SIZE).convert("RGB")
+        return self._thumbnail
+
+    @property
+    def base64(self) -> str:
+        """Imagen en base64 lista para enviar al modelo como JPEG"""
+        if self._base64 is None:
+            with self._lock:
+                if self._base64 is None:
+                    if self.format == "JPEG":
+                        data = self.raw_bytes
+                    else:
+                        # Otros formatos se recodifican a JPEG para el data URL
+                        buffer = BytesIO()
+                        self.image.convert("RGB").save(buffer, format="JPEG", quality=85)
+                        data = buffer.getvalue()
+                    self._base64 = base64.b64encode(data).decode("ascii")
+        return self._base64
+
+    def para_modelo(self, max_lado: int = 0, calidad: int = 0):
+        """Base64 reducido/recodificado para el modelo: (base64, bytes enviados)
+
+        `max_lado` limita el lado mayor en píxeles y `calidad` es la calidad
+        JPEG; con ambos en 0 se envía la imagen tal como llegó.
+        """
+        clave = (max_lado, calidad)
+        if clave not in self._para_modelo:
+            with self._lock:
+                if clave not in self._para_modelo:
+                    self._para_modelo[clave] = self._codificar_para_modelo(max_lado, calidad)
+        return self._para_modelo[clave]
+
+    def _codificar_para_modelo(self, max_lado, calidad):
+        cabe = not max_lado or max(self.width, self.height) <= max_lado
+        if cabe and not calidad and self.format == "JPEG":
+            # Ya es un JPEG del tamaño permitido y no se pide otra calidad
+            return self.base64, self.size_bytes
+
+        img = Image.open(BytesIO(self.raw_bytes))
+        if not cabe:
+            # thumbnail() usa el modo draft del decodificador JPEG, así que
+            # no hace falta decodificar la imagen completa para reducirla
+            img.thumbnail((max_lado, max_lado), Image.LANCZOS)
+        buffer = BytesIO()
+        img.convert("RGB").save(buffer, format="JPEG", quality=calidad or 85)
+        data = buffer.getvalue()
+
+        if self.format == "JPEG" and len(data) >= self.size_bytes:
+            # Recodificar no ahorró nada: enviar el original
+            return self.base64, self.size_bytes
+        return base64.b64encode(data).decode("ascii"), len(data)
+
+    @property
+    def stats(self) -> dict:
+        """Estadísticas de píxeles: dimensiones (de la cabecera), brillo y contraste"""
+        if self._stats is None:
+            with self._lock:
+                if self._stats is None:
+                    import numpy as np
+
+                    # Media y desviación sobre una decodificación reducida (no se guarda en
+                    # self.image): el resultado es prácticamente el mismo que con todos los
+                    # píxeles. Acumulación en float64 para cualquier modo (también "I"/"F")
+                    img_array = np.asarray(self._decodificar_reducida(STATS_SIZE))
+                    self._stats = {
+                        "width": self.width,
+                        "height": self.height,
+                        "brightness": np.mean(img_array, dtype=np.float64),
+                        "contrast": np.std(img_array, dtype=np.float64),
+                    }
+        return self._stats
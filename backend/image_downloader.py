@@ -0,0 +1,163 @@
+"""
+Descarga de imágenes por URL con un cliente HTTP compartido.
+
+Un único `httpx.AsyncClient` mantiene las conexiones abiertas (keep-alive)
+entre peticiones, limita las descargas simultáneas por host y corta la
+descarga en cuanto supera el tamaño máximo, sin cargarla entera en memoria.
+"""
+
+import asyncio
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit, urlunsplit
+
+import httpx
+
+from deadline import esperar_con_plazo, plazo_agotado, plazo_vencido, verificar_plazo
+
+# Configuración del descargador
+DESCARGA_CONFIG = {
+    'max_bytes': int(os.getenv("DESCARGA_MAX_MB", "20")) * 1024 * 1024,
+    'timeout_segundos': float(os.getenv("DESCARGA_TIMEOUT_SEGUNDOS", "15")),
+    'max_conexiones': int(os.getenv("DESCARGA_MAX_CONEXIONES", "20")),
+    'max_por_host': int(os.getenv("DESCARGA_MAX_POR_HOST", "4")),
+    # Hosts distintos con semáforo guardado; los menos usados recientemente se descartan
+    'max_hosts': int(os.getenv("DESCARGA_MAX_HOSTS", "256")),
+}
+
+
+def normalizar_url(url: str) -> str:
+    """Forma canónica de una URL: esquema y host en minúsculas, sin puerto por defecto ni fragmento"""
+    partes = urlsplit(url.strip())
+    esquema = partes.scheme.lower()
+    host = (partes.hostname or "").lower()
+    puerto = partes.port
+    if puerto and (esquema, puerto) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{puerto}"
+    return urlunsplit((esquema, host, partes.path or "/", partes.query, ""))
+
+
+class DescargaError(Exception):
+    """La imagen no se pudo descargar"""
+
+
+class ImagenDemasiadoGrandeError(DescargaError):
+    """La imagen supera el tamaño máximo permitido"""
+
+
+class ImageDownloader:
+    """Cliente HTTP asíncrono compartido con límite de tamaño y de concurrencia por host"""
+
+    def __init__(self, config: dict = None):
+        self.config = config or DESCARGA_CONFIG
+        self._client = None
+        self._loop = None
+        self._hosts = OrderedDict()  # host -> [semáforo, descargas usándolo] (LRU)
+
+    async def _cliente(self) -> httpx.AsyncClient:
+        """Cliente del event loop actual (los scripts síncronos usan un loop por llamada)"""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            anterior, loop_anterior = self._client, self._loop
+            self._client = httpx.AsyncClient(
+                timeout=self.config['timeout_segundos'],
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.config['max_conexiones'],
+                    max_keepalive_connections=self.config['max_conexiones'],
+                ),
+            )
+            self._loop = loop
+            self._hosts = OrderedDict()
+            if anterior is not None:
+                await self._cerrar_cliente(anterior, loop_anterior)
+        return self._client
+
+    @staticmethod
+    async def _cerrar_cliente(cliente, loop):
+        """Cierra el cliente de otro event loop para no dejar su pool de conexiones abierto"""
+        if loop is not None and loop.is_running():
+            # Sigue vivo en otro hilo: que lo cierre su propio loop
+            asyncio.run_coroutine_threadsafe(cliente.aclose(), loop)
+            return
+        try:
+            await cliente.aclose()
+        except Exception as e:
+            # Loop anterior ya cerrado: sus sockets se cerraron con él
+            print(f"⚠️ Cliente HTTP anterior cerrado con error: {e}")
+
+    @asynccontextmanager
+    async def _limite_host(self, url: str):
+        """Limita las descargas simultáneas por host"""
+        host = urlsplit(url).hostname or ""
+        entrada = self._hosts.get(host)
+        if entrada is None:
+            entrada = self._hosts[host] = [asyncio.Semaphore(self.config['max_por_host']), 0]
+        self._hosts.move_to_end(host)
+        entrada[1] += 1
+        self._podar_hosts()
+        try:
+            async with entrada[0]:
+                yield
+        finally:
+            entrada[1] -= 1
+
+    def _podar_hosts(self):
+        """Descarta los semáforos menos usados recientemente que no tienen descargas en curso"""
+        exceso = len(self._hosts) - self.config['max_hosts']
+        if exceso <= 0:
+            return
+        libres = [host for host, (_, en_uso) in self._hosts.items() if en_uso == 0]
+        for host in libres[:exceso]:
+            del self._hosts[host]
+
+    async def descargar(self, url: str) -> bytes:
+        """Descarga la imagen en streaming; DescargaError si falla o es demasiado grande
+
+        Respeta el plazo de la petición en curso (PlazoAgotadoError si se agota).
+        """
+        verificar_plazo("descarga")
+        try:
+            return await esperar_con_plazo(self._descargar(url))
+        except asyncio.TimeoutError:
+            if plazo_vencido():
+                raise plazo_agotado("descarga") from None
+            raise
+
+    async def _descargar(self, url: str) -> bytes:
+        max_bytes = self.config['max_bytes']
+        client = await self._cliente()
+
+        async with self._limite_host(url):
+            try:
+                async with client.stream("GET", url) as response:
+                    response.raise_for_status()
+
+                    declarado = response.headers.get("content-length")
+                    if declarado and declarado.isdigit() and int(declarado) > max_bytes:
+                        raise ImagenDemasiadoGrandeError(f"La imagen pesa {int(declarado)} bytes (máximo {max_bytes})")
+
+                    buffer = bytearray()
+                    async for bloque in response.aiter_bytes():
+                        buffer += bloque
+                        if len(buffer) > max_bytes:
+                            raise ImagenDemasiadoGrandeError(f"La imagen supera el máximo de {max_bytes} bytes")
+            except httpx.HTTPError as e:
+                raise DescargaError(str(e)) from e
+
+        if not buffer:
+            raise DescargaError("La respuesta está vacía")
+        return bytes(buffer)
+
+    async def cerrar(self):
+        """Cierra las conexiones abiertas"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._loop = None
+            self._hosts = OrderedDict()
+
+
+# Descargador compartido por toda la aplicación
+DESCARGADOR = ImageDownloader()
@@ -0,0 +1,204 @@
+"""
+Almacén de trabajos (jobs) de análisis en segundo plano.
+
+La API guarda cada trabajo en SQLite y responde enseguida con su id; los
+workers (embebidos en la API o en otro proceso con `python job_worker.py`)
+toman los pendientes, corren el análisis y guardan el resultado. Como el
+estado vive en el archivo, API y workers escalan por separado y un corte de
+conexión del cliente no pierde el análisis: se consulta después por el id.
+
+Estados: pendiente -> procesando -> completado | error
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from prediction_cache import serializar_resultado
+
+# Configuración de la cola de trabajos
+JOBS_CONFIG = {
+    'db_path': os.getenv("JOBS_DB_PATH", os.path.join(os.path.dirname(__file__), 'jobs.sqlite3')),
+    'retencion_horas': float(os.getenv("JOBS_RETENCION_HORAS", "24")),
+    # Un trabajo "procesando" sin terminar pasado este tiempo se considera de un worker caído
+    'huerfano_segundos': float(os.getenv("JOBS_HUERFANO_SEGUNDOS", "600")),
+    'max_intentos': int(os.getenv("JOBS_MAX_INTENTOS", "2")),
+}
+
+PENDIENTE = "pendiente"
+PROCESANDO = "procesando"
+COMPLETADO = "completado"
+ERROR = "error"
+ESTADOS_FINALES = (COMPLETADO, ERROR)
+
+
+class JobStore:
+    """Trabajos de análisis en SQLite, compartidos entre la API y los workers"""
+
+    def __init__(self, db_path: str = None, config: dict = None):
+        self.config = config or JOBS_CONFIG
+        self.db_path = db_path or self.config['db_path']
+        self._lock = threading.Lock()
+        # timeout: espera el bloqueo de escritura de otro proceso en lugar de fallar
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        if self.db_path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")  # lecturas de la API sin bloquear a los workers
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                estado TEXT NOT NULL,
+                creado_en REAL NOT NULL,
+                actualizado_en REAL NOT NULL,
+                iniciado_en REAL,
+                terminado_en REAL,
+                nombre TEXT,
+                url TEXT,
+                imagen BLOB,
+                resultado TEXT,
+                error TEXT,
+                worker TEXT,
+                intentos INTEGER NOT NULL DEFAULT 0
+            )"""
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_estado ON jobs (estado, creado_en)")
+
+    def crear(self, imagen: bytes = None, nombre: str = None, url: str = None) -> str:
+        """Registra un trabajo pendiente (con la imagen o la URL a descargar) y devuelve su id"""
+        if imagen is None and not url:
+            raise ValueError("El trabajo necesita una imagen o una URL")
+        job_id = uuid.uuid4().hex
+        ahora = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, estado, creado_en, actualizado_en, nombre, url, imagen) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, PENDIENTE, ahora, ahora, nombre, url, imagen),
+            )
+        return job_id
+
+    def obtener(self, job_id: str):
+        """Estado público del trabajo (sin la imagen), o None si no existe"""
+        with self._lock:
+            fila = self._db.execute(
+                """SELECT id, estado, creado_en, actualizado_en, iniciado_en, terminado_en,
+                          nombre, url, resultado, error, intentos
+                   FROM jobs WHERE id = ?""",
+                (job_id,),
+            ).fetchone()
+        if fila is None:
+            return None
+        trabajo = dict(fila)
+        trabajo['resultado'] = json.loads(trabajo['resultado']) if trabajo['resultado'] else None
+        trabajo['posicion_en_cola'] = self._posicion(trabajo) if trabajo['estado'] == PENDIENTE else None
+        return trabajo
+
+    def _posicion(self, trabajo) -> int:
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE estado = ? AND creado_en < ?",
+                (PENDIENTE, trabajo['creado_en']),
+            ).fetchone()[0] + 1
+
+    def tomar(self, worker: str):
+        """Reserva el pendiente más antiguo para `worker`; devuelve el trabajo con su imagen o None"""
+        ahora = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")  # reserva atómica entre procesos
+            try:
+                self._recuperar_huerfanos(ahora)
+                fila = self._db.execute(
+                    "SELECT id, nombre, url, imagen, intentos FROM jobs WHERE estado = ? ORDER BY creado_en LIMIT 1",
+                    (PENDIENTE,),
+                ).fetchone()
+                if fila is None:
+                    self._db.execute("COMMIT")
+                    return None
+                self._db.execute(
+                    """UPDATE jobs SET estado = ?, worker = ?, iniciado_en = ?, actualizado_en = ?,
+                                       intentos = intentos + 1
+                       WHERE id = ?""",
+                    (PROCESANDO, worker, ahora, ahora, fila['id']),
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        trabajo = dict(fila)
+        trabajo['intentos'] += 1
+        return trabajo
+
+    def _recuperar_huerfanos(self, ahora):
+        """Devuelve a la cola los trabajos de workers caídos (llamar dentro de la transacción)"""
+        limite = ahora - self.config['huerfano_segundos']
+        self._db.execute(
+            """UPDATE jobs SET estado = ?, error = 'Se agotaron los intentos (worker caído)',
+                               terminado_en = ?, actualizado_en = ?, imagen = NULL
+               WHERE estado = ? AND iniciado_en < ? AND intentos >= ?""",
+            (ERROR, ahora, ahora, PROCESANDO, limite, self.config['max_intentos']),
+        )
+        recuperados = self._db.execute(
+            "UPDATE jobs SET estado = ?, worker = NULL, actualizado_en = ? WHERE estado = ? AND iniciado_en < ?",
+            (PENDIENTE, ahora, PROCESANDO, limite),
+        ).rowcount
+        if recuperados:
+            print(f"♻️ {recuperados} trabajo(s) de un worker caído vuelven a la cola")
+
+    def completar(self, job_id: str, resultado: dict):
+        ahora = time.time()
+        serializado = serializar_resultado(resultado)
+        with self._lock:
+            self._db.execute(
+                """UPDATE jobs SET estado = ?, resultado = ?, error = NULL, terminado_en = ?,
+                                   actualizado_en = ?, imagen = NULL
+                   WHERE id = ?""",
+                (COMPLETADO, serializado, ahora, ahora, job_id),
+            )
+
+    def fallar(self, job_id: str, error: str):
+        ahora = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET estado = ?, error = ?, terminado_en = ?, actualizado_en = ?, imagen = NULL WHERE id = ?",
+                (ERROR, error, ahora, ahora, job_id),
+            )
+
+    def reencolar(self, job_id: str, error: str = None):
+        """Devuelve el trabajo a la cola (p. ej. modelo saturado) sin contar el intento"""
+        with self._lock:
+            self._db.execute(
+                """UPDATE jobs SET estado = ?, worker = NULL, error = ?, actualizado_en = ?,
+                                   intentos = MAX(0, intentos - 1)
+                   WHERE id = ?""",
+                (PENDIENTE, error, time.time(), job_id),
+            )
+
+    def purgar(self) -> int:
+        """Elimina los trabajos terminados hace más que la retención"""
+        limite = time.time() - self.config['retencion_horas'] * 3600
+        with self._lock:
+            eliminados = self._db.execute(
+                f"DELETE FROM jobs WHERE estado IN ({','.join('?' * len(ESTADOS_FINALES))}) AND terminado_en < ?",
+                (*ESTADOS_FINALES, limite),
+            ).rowcount
+        if eliminados:
+            print(f"🧹 {eliminados} trabajo(s) antiguos eliminados")
+        return eliminados
+
+    def stats(self) -> dict:
+        with self._lock:
+            conteos = dict(self._db.execute("SELECT estado, COUNT(*) FROM jobs GROUP BY estado").fetchall())
+            duracion = self._db.execute(
+                "SELECT AVG(terminado_en - iniciado_en) FROM jobs WHERE estado = ? AND iniciado_en IS NOT NULL",
+                (COMPLETADO,),
+            ).fetchone()[0]
+        return {
+            'pendientes': conteos.get(PENDIENTE, 0),
+            'procesando': conteos.get(PROCESANDO, 0),
+            'completados': conteos.get(COMPLETADO, 0),
+            'con_error': conteos.get(ERROR, 0),
+            'duracion_promedio_s': round(duracion, 2) if duracion is not None else None,
+            'db_path': self.db_path,
+        }
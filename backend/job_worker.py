@@ -0,0 +1,130 @@
+"""
+Pool de workers que procesa los trabajos de análisis guardados en `JobStore`.
+
+Por defecto corre embebido en la API (JOBS_WORKER_EMBEBIDO=1). Para escalar
+los workers por separado se desactiva en la API y se lanzan procesos aparte
+apuntando al mismo JOBS_DB_PATH:
+
+    python job_worker.py
+"""
+
+import asyncio
+import os
+import socket
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv("config.env")
+
+from deadline import plazo
+from image_context import ImageContext
+from image_downloader import DESCARGADOR
+from job_store import JobStore
+from langchain_utils_simulado import analyze_cow_image_with_json_output_async
+from llm_governor import LLMSaturadoError
+
+# Configuración del pool de workers
+WORKERS_CONFIG = {
+    'workers': int(os.getenv("JOBS_WORKERS", "2")),
+    'embebido': os.getenv("JOBS_WORKER_EMBEBIDO", "1") == "1",
+    'espera_segundos': float(os.getenv("JOBS_ESPERA_SEGUNDOS", "1")),
+    # Sin conexión HTTP abierta el plazo puede ser el del análisis completo
+    'plazo_segundos': float(os.getenv("JOBS_PLAZO_SEGUNDOS", "230")),
+}
+
+PURGA_CADA_SEGUNDOS = 3600
+
+
+class PoolWorkers:
+    """Workers async que toman trabajos pendientes y guardan el resultado del análisis"""
+
+    def __init__(self, store: JobStore, config: dict = None):
+        self.store = store
+        self.config = config or WORKERS_CONFIG
+        self._tareas = []
+        self._ultima_purga = 0.0
+        self._prefijo = f"{socket.gethostname()}:{os.getpid()}"
+
+    def iniciar(self):
+        """Lanza los workers en el event loop actual"""
+        if self._tareas:
+            return
+        for i in range(self.config['workers']):
+            self._tareas.append(asyncio.create_task(self._worker(f"{self._prefijo}:{i}")))
+        print(f"👷 {self.config['workers']} worker(s) de análisis iniciados ({self.store.db_path})")
+
+    async def detener(self):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+
+    async def _worker(self, nombre: str):
+        while True:
+            try:
+                if time.monotonic() - self._ultima_purga > PURGA_CADA_SEGUNDOS:
+                    self._ultima_purga = time.monotonic()
+                    await asyncio.to_thread(self.store.purgar)
+
+                trabajo = await asyncio.to_thread(self.store.tomar, nombre)
+                if trabajo is None:
+                    await asyncio.sleep(self.config['espera_segundos'])
+                    continue
+                await self.procesar(trabajo)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Un error del almacén no debe matar al worker
+                print(f"❌ Error en el worker {nombre}: {e}")
+                await asyncio.sleep(self.config['espera_segundos'])
+
+    async def procesar(self, trabajo: dict):
+        """Corre el análisis de un trabajo y guarda el resultado o el error"""
+        job_id = trabajo['id']
+        print(f"⚙️ Procesando trabajo {job_id} (intento {trabajo['intentos']})")
+        inicio = time.perf_counter()
+        try:
+            with plazo(self.config['plazo_segundos']):
+                imagen = trabajo['imagen']
+                if imagen is None:
+                    imagen = await DESCARGADOR.descargar(trabajo['url'])
+                ctx = await asyncio.to_thread(ImageContext, imagen, trabajo['nombre'] or trabajo['url'])
+                resultado = await analyze_cow_image_with_json_output_async(ctx)
+        except LLMSaturadoError as e:
+            # Vuelve a la cola y este worker espera lo que indica el gobernador
+            print(f"🚦 Modelo saturado, trabajo {job_id} reencolado ({e.retry_after}s)")
+            await asyncio.to_thread(self.store.reencolar, job_id, str(e))
+            await asyncio.sleep(e.retry_after)
+            return
+        except asyncio.CancelledError:
+            # Apagado del worker: otro lo retoma
+            await asyncio.to_thread(self.store.reencolar, job_id, "Worker detenido")
+            raise
+        except Exception as e:
+            print(f"❌ Trabajo {job_id} con error: {type(e).__name__}: {e}")
+            await asyncio.to_thread(self.store.fallar, job_id, f"{type(e).__name__}: {e}")
+            return
+
+        if not resultado:
+            await asyncio.to_thread(self.store.fallar, job_id, "No se pudo procesar la imagen con la IA")
+            return
+        await asyncio.to_thread(self.store.completar, job_id, resultado)
+        print(f"✅ Trabajo {job_id} completado en {time.perf_counter() - inicio:.1f}s")
+
+
+async def _ejecutar_pool():
+    pool = PoolWorkers(JobStore())
+    pool.iniciar()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await pool.detener()
+        await DESCARGADOR.cerrar()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_ejecutar_pool())
+    except KeyboardInterrupt:
+        print("👋 Workers detenidos")
@@ -0,0 +1,262 @@
+"""
+Gobernador de llamadas al modelo.
+
+Todas las llamadas a `llm` pasan por un único `GobernadorLLM` que:
+- limita cuántas hay en vuelo a la vez en todo el proceso (también entre los
+  event loops de los wrappers síncronos y los benchmarks),
+- respeta los límites del proveedor de peticiones y tokens por minuto (token buckets),
+- reintenta los errores transitorios (429, timeouts, 5xx) con backoff exponencial y jitter,
+- rechaza con `LLMSaturadoError` cuando la cola de espera ya es demasiado larga,
+  para responder 503 con Retry-After en lugar de esperar hasta el timeout.
+"""
+
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import openai
+
+# Configuración del gobernador (0 en un límite por minuto = sin límite)
+GOBERNADOR_CONFIG = {
+    'max_concurrencia': int(os.getenv("LLM_MAX_CONCURRENCIA", "8")),
+    'peticiones_por_minuto': int(os.getenv("LLM_PETICIONES_POR_MINUTO", "500")),
+    'tokens_por_minuto': int(os.getenv("LLM_TOKENS_POR_MINUTO", "200000")),
+    'max_en_cola': int(os.getenv("LLM_MAX_EN_COLA", "32")),
+    'max_reintentos': int(os.getenv("LLM_MAX_REINTENTOS", "3")),
+    'backoff_base_segundos': float(os.getenv("LLM_BACKOFF_BASE_SEGUNDOS", "1")),
+    'backoff_max_segundos': float(os.getenv("LLM_BACKOFF_MAX_SEGUNDOS", "20")),
+}
+
+# Errores del proveedor que vale la pena reintentar
+ERRORES_REINTENTABLES = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # incluye APITimeoutError
+    openai.InternalServerError,
+)
+
+
+class LLMSaturadoError(Exception):
+    """Hay demasiadas llamadas al modelo esperando; reintentar después de `retry_after` segundos"""
+
+    def __init__(self, mensaje: str, retry_after: int):
+        super().__init__(mensaje)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Cubeta con recarga continua de `por_minuto` unidades por minuto"""
+
+    def __init__(self, por_minuto: float):
+        self.capacidad = float(por_minuto)
+        self.disponibles = float(por_minuto)
+        self._ultima_recarga = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reservar(self, cantidad: float) -> float:
+        """Reserva `cantidad` y devuelve cuántos segundos esperar antes de usarla
+
+        La reserva se hace de inmediato (la cubeta puede quedar en negativo), así
+        las llamadas que esperan respetan el orden de llegada.
+        """
+        if self.capacidad <= 0:
+            return 0.0
+        # Una llamada más grande que el límite de un minuto no debe bloquearse para siempre
+        cantidad = min(cantidad, self.capacidad)
+        with self._lock:
+            ahora = time.monotonic()
+            recarga = (ahora - self._ultima_recarga) * self.capacidad / 60
+            self.disponibles = min(self.capacidad, self.disponibles + recarga)
+            self._ultima_recarga = ahora
+            self.disponibles -= cantidad
+            if self.disponibles >= 0:
+                return 0.0
+            return -self.disponibles * 60 / self.capacidad
+
+    def devolver(self, cantidad: float):
+        """Devuelve una reserva que no se usó (la llamada se canceló antes de enviarse)"""
+        if self.capacidad <= 0:
+            return
+        cantidad = min(cantidad, self.capacidad)
+        with self._lock:
+            self.disponibles = min(self.capacidad, self.disponibles + cantidad)
+
+
+class CupoConcurrencia:
+    """Semáforo de todo el proceso: lo comparten las llamadas de cualquier event loop
+
+    Un asyncio.Semaphore pertenece a un solo loop; cada `asyncio.run` de los
+    wrappers síncronos tendría su propio cupo completo. Acá el contador está
+    protegido por un lock de threading y el cupo que se libera se le entrega
+    al primero que espera, en su propio loop.
+    """
+
+    def __init__(self, maximo: int):
+        self.maximo = max(1, maximo)
+        self.en_uso = 0
+        self._lock = threading.Lock()
+        self._esperando = deque()  # (loop, future) en orden de llegada
+
+    async def tomar(self):
+        with self._lock:
+            if self.en_uso < self.maximo and not self._esperando:
+                self.en_uso += 1
+                return
+            loop = asyncio.get_running_loop()
+            turno = loop.create_future()
+            self._esperando.append((loop, turno))
+        try:
+            await turno
+        except asyncio.CancelledError:
+            with self._lock:
+                try:
+                    self._esperando.remove((loop, turno))
+                    entregado = False
+                except ValueError:
+                    entregado = True  # el cupo ya venía en camino
+            if entregado and turno.done() and not turno.cancelled():
+                self.liberar()
+            raise
+
+    def liberar(self):
+        with self._lock:
+            while self._esperando:
+                loop, turno = self._esperando.popleft()
+                if loop.is_closed():
+                    continue
+                # El cupo pasa directo al que espera (en_uso no cambia)
+                loop.call_soon_threadsafe(self._entregar, turno)
+                return
+            self.en_uso -= 1
+
+    def _entregar(self, turno):
+        if turno.done():
+            # Se canceló mientras el cupo llegaba: pasarlo al siguiente
+            self.liberar()
+        else:
+            turno.set_result(True)
+
+
+class GobernadorLLM:
+    """Punto único de paso de las llamadas al modelo (concurrencia, ritmo, reintentos y cola)"""
+
+    def __init__(self, config: dict = None):
+        self.config = config or GOBERNADOR_CONFIG
+        self.peticiones = TokenBucket(self.config['peticiones_por_minuto'])
+        self.tokens = TokenBucket(self.config['tokens_por_minuto'])
+        self._lock = threading.Lock()
+        self._cupo = CupoConcurrencia(self.config['max_concurrencia'])
+        self._latencias = deque(maxlen=100)
+        self.en_cola = 0
+        self.en_vuelo = 0
+        self.llamadas = 0
+        self.reintentos = 0
+        self.rechazadas = 0
+        self.esperas_por_limite = 0
+
+    def retry_after(self) -> int:
+        """Segundos estimados hasta que la cola actual se vacíe"""
+        latencia = sum(self._latencias) / len(self._latencias) if self._latencias else 10.0
+        tandas = (self.en_cola + self.en_vuelo) / max(1, self.config['max_concurrencia'])
+        return max(1, math.ceil(latencia * tandas))
+
+    def _encolar(self, admitir: bool):
+        with self._lock:
+            if admitir and self.en_cola >= self.config['max_en_cola']:
+                self.rechazadas += 1
+                raise LLMSaturadoError(
+                    f"{self.en_cola} llamadas al modelo en espera (máximo {self.config['max_en_cola']})",
+                    self.retry_after(),
+                )
+            self.en_cola += 1
+
+    async def ejecutar(self, fabrica, tokens_estimados: int = 0):
+        """Ejecuta `await fabrica()` respetando los límites; reintenta los errores transitorios"""
+        self._encolar(admitir=True)
+        intento = 0
+        while True:
+            try:
+                return await self._llamar(fabrica, tokens_estimados)
+            except ERRORES_REINTENTABLES as e:
+                espera = self._espera_reintento(e, intento)
+                if espera is None:
+                    raise
+                intento += 1
+                with self._lock:
+                    self.reintentos += 1
+                print(f"🔁 Error transitorio del modelo ({type(e).__name__}), reintento {intento} en {espera:.1f}s")
+                await asyncio.sleep(espera)
+                self._encolar(admitir=False)  # Ya estaba admitida: vuelve a la cola sin rechazo
+
+    async def _llamar(self, fabrica, tokens_estimados):
+        try:
+            espera = max(self.peticiones.reservar(1), self.tokens.reservar(tokens_estimados))
+            try:
+                if espera > 0:
+                    with self._lock:
+                        self.esperas_por_limite += 1
+                    await asyncio.sleep(espera)
+                await self._cupo.tomar()
+            except asyncio.CancelledError:
+                # Cancelada antes de enviarse (plazo, cliente que se fue): la reserva no se usó
+                self.peticiones.devolver(1)
+                self.tokens.devolver(tokens_estimados)
+                raise
+        finally:
+            with self._lock:
+                self.en_cola -= 1
+
+        with self._lock:
+            self.en_vuelo += 1
+            self.llamadas += 1
+        inicio = time.monotonic()
+        try:
+            resultado = await fabrica()
+            self._latencias.append(time.monotonic() - inicio)
+            return resultado
+        finally:
+            with self._lock:
+                self.en_vuelo -= 1
+            self._cupo.liberar()
+
+    def _espera_reintento(self, error, intento):
+        """Segundos a esperar antes del próximo intento, o None si no hay que reintentar"""
+        if intento >= self.config['max_reintentos']:
+            return None
+        if getattr(error, 'code', None) == 'insufficient_quota':
+            return None  # Sin saldo: reintentar no sirve
+
+        tope = min(self.config['backoff_max_segundos'], self.config['backoff_base_segundos'] * 2 ** intento)
+        espera = random.uniform(0, tope)  # Full jitter: evita que los reintentos lleguen todos juntos
+
+        # Si el proveedor indica cuánto esperar, respetarlo
+        respuesta = getattr(error, 'response', None)
+        indicado = respuesta.headers.get('retry-after') if respuesta is not None else None
+        try:
+            if indicado:
+                espera = max(espera, float(indicado))
+        except ValueError:
+            pass
+        return espera
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencias = list(self._latencias)
+            return {
+                'max_concurrencia': self.config['max_concurrencia'],
+                'en_vuelo': self.en_vuelo,
+                'en_cola': self.en_cola,
+                'max_en_cola': self.config['max_en_cola'],
+                'llamadas': self.llamadas,
+                'reintentos': self.reintentos,
+                'rechazadas': self.rechazadas,
+                'esperas_por_limite': self.esperas_por_limite,
+                'latencia_promedio_s': round(sum(latencias) / len(latencias), 3) if latencias else None,
+            }
+
+
+# Gobernador compartido por toda la aplicación
+GOBERNADOR = GobernadorLLM()
@@ -1,17 +1,23 @@
-from fastapi import FastAPI, HTTPException, Form, File, UploadFile, Depends, Header
+from fastapi import FastAPI, HTTPException, Form, File, UploadFile, Depends, Header, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
-import requests
-from io import BytesIO
-from PIL import Image
 import os
-import tempfile
-from langchain_utils_simulado import analyze_cow_image_with_json_output
+from langchain_utils_simulado import analyze_cow_image_with_json_output_async, CIRCUITO_LLM
+from image_context import ImageContext
+from llm_governor import LLMSaturadoError
+from deadline import PlazoAgotadoError, con_plazo, plazo
+from image_downloader import DESCARGADOR, DescargaError, ImagenDemasiadoGrandeError
+from upload_limits import LimiteUploadMiddleware, RutaUploadLimitado, leer_form_limitado, leer_upload_limitado
+from job_store import JobStore, ESTADOS_FINALES, COMPLETADO
+from job_worker import PoolWorkers, WORKERS_CONFIG
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import timedelta
 from contextlib import asynccontextmanager
 import asyncio
+import json
+import time
 from dotenv import load_dotenv
 
 # Cargar variables de entorno desde config.env
@@ -43,8 +49,99 @@ def check_maintenance_mode():
             }
         )
 
+def error_modelo_saturado(error: LLMSaturadoError) -> HTTPException:
+    """503 con Retry-After cuando la cola de llamadas al modelo está llena"""
+    print(f"🚦 Modelo saturado, reintentar en {error.retry_after}s: {error}")
+    return HTTPException(
+        status_code=503,
+        detail={
+            "error": "modelo_saturado",
+            "message": "El servicio de análisis está saturado. Intenta nuevamente en unos segundos.",
+            "retry_after": error.retry_after
+        },
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+def respuesta_prediccion(resultado: dict) -> dict:
+    """Respuesta de predicción con todos los campos que espera el frontend"""
+    return {
+        "peso": resultado.get("peso", 400),
+        "precio": resultado.get("precio"),
+        "tamaño": resultado.get("tamaño", "medio"),
+        "condicion": resultado.get("condicion", "buena"),
+        "recomendaciones": resultado.get("recomendaciones", {
+            "nutricion": [
+                "Mantener dieta balanceada con forraje de calidad",
+                "Suplementar con sales minerales",
+                "Proporcionar agua limpia y fresca"
+            ],
+            "manejo": [
+                "Realizar controles regulares de peso",
+                "Mantener instalaciones limpias",
+                "Programar rotación de pasturas"
+            ],
+            "salud": [
+                "Calendario de vacunación al día",
+                "Revisión veterinaria periódica",
+                "Control de parásitos interno y externo"
+            ]
+        }),
+        "metodologia": resultado.get("metodologia"),
+        "peso_openai": resultado.get("peso_openai"),
+        "peso_dataset": resultado.get("peso_dataset"),
+        "peso_original": resultado.get("peso_original"),
+        "factor_correccion_global": resultado.get("factor_correccion_global"),
+        "confianza": resultado.get("confianza"),
+        "observaciones": resultado.get("observaciones"),
+        "dispositivo": resultado.get("dispositivo"),
+        "ajustes_aplicados": resultado.get("ajustes_aplicados"),
+        "intentos_usados": resultado.get("intentos_usados"),
+        "degradado": resultado.get("degradado", False)
+    }
+
+def formato_sse(evento: str, datos) -> str:
+    """Mensaje Server-Sent Events con datos JSON"""
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False, default=str)}\n\n"
+
+# Tiempo máximo de análisis por petición (segundos)
+ANALISIS_TIMEOUT_SEGUNDOS = 240
+# Margen para que el ensemble devuelva un consenso parcial antes del timeout HTTP
+MARGEN_CONSENSO_SEGUNDOS = 10
+# Plazo que ven todas las etapas del pipeline (descarga, codificación, ensemble, autocorrección, dataset)
+PLAZO_PETICION_SEGUNDOS = ANALISIS_TIMEOUT_SEGUNDOS - MARGEN_CONSENSO_SEGUNDOS
+
+# Inicializar base de datos y workers al startup
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Inicializar la base de datos al arrancar la aplicación y liberar recursos al apagarla"""
+    try:
+        print("🔧 Inicializando base de datos...")
+        create_tables()
+        print("✅ Tablas de base de datos creadas")
+        
+        # Probar conexión
+        if test_connection():
+            print("✅ Conexión a MySQL exitosa")
+        else:
+            print("⚠️ Advertencia: No se pudo conectar a la base de datos")
+    except Exception as e:
+        print(f"❌ Error inicializando base de datos: {e}")
+    
+    # Workers embebidos de /jobs (JOBS_WORKER_EMBEBIDO=0 si corren en otro proceso)
+    if WORKERS_CONFIG['embebido']:
+        POOL_WORKERS.iniciar()
+    
+    try:
+        yield  # La aplicación está ejecutándose
+    finally:
+        await POOL_WORKERS.detener()
+        # Cierra las conexiones del cliente HTTP compartido
+        await DESCARGADOR.cerrar()
+
 # Crear la aplicación FastAPI
-app = FastAPI(title="AgroTech Vision API", version="1.0.0")
+app = FastAPI(title="AgroTech Vision API", version="1.0.0", lifespan=lifespan)
+# Los formularios multipart de todas las rutas se leen con el tope por archivo (ver upload_limits)
+app.router.route_class = RutaUploadLimitado
 
 # Endpoint de healthcheck para Railway - MUY SIMPLE
 @app.get("/")
@@ -79,9 +176,44 @@ async def system_status():
         "maintenance_mode": MAINTENANCE_MODE,
         "message": MAINTENANCE_MESSAGE if MAINTENANCE_MODE else "Sistema operativo",
         "ai_enabled": not MAINTENANCE_MODE,
+        "circuito_llm": CIRCUITO_LLM.stats(),
+        "jobs": JOBS.stats(),
         "timestamp": __import__('datetime').datetime.now().isoformat()
     }
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Estadísticas de la caché de predicciones (aciertos, fallos, ocupación)"""
+    from langchain_utils_simulado import PREDICTION_CACHE
+    if PREDICTION_CACHE is None:
+        return {"enabled": False}
+    return {"enabled": True, **PREDICTION_CACHE.stats()}
+
+@app.get("/metrics")
+async def pipeline_metrics():
+    """Métricas del pipeline (preprocesamiento de imagen, latencia del modelo)"""
+    from langchain_utils_simulado import obtener_metricas
+    return obtener_metricas()
+
+@app.post("/admin/cache/clear")
+async def clear_cache():
+    """Vacía la caché de predicciones"""
+    from langchain_utils_simulado import PREDICTION_CACHE
+    if PREDICTION_CACHE is None:
+        return {"success": True, "enabled": False}
+    PREDICTION_CACHE.clear()
+    return {"success": True, "enabled": True}
+
+@app.post("/admin/dataset/reload")
+async def reload_dataset():
+    """Recarga el dataset de referencia y publica una nueva instantánea"""
+    import langchain_utils_simulado as pipeline
+    ok = await asyncio.to_thread(pipeline.load_dataset_reference)
+    snapshot = pipeline.obtener_dataset_snapshot()
+    if not ok or snapshot is None:
+        raise HTTPException(status_code=500, detail="No se pudo cargar el dataset de referencia")
+    return {"success": True, **snapshot.info()}
+
 # ===== ENDPOINTS DE ADMINISTRACIÓN DE MANTENIMIENTO =====
 
 class MaintenanceRequest(BaseModel):
@@ -156,30 +288,17 @@ from models import (
     ErrorResponse
 )
 
-# Inicializar base de datos al startup
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """Inicializar la base de datos al arrancar la aplicación"""
-    try:
-        print("🔧 Inicializando base de datos...")
-        create_tables()
-        print("✅ Tablas de base de datos creadas")
-        
-        # Probar conexión
-        if test_connection():
-            print("✅ Conexión a MySQL exitosa")
-        else:
-            print("⚠️ Advertencia: No se pudo conectar a la base de datos")
-    except Exception as e:
-        print(f"❌ Error inicializando base de datos: {e}")
-    
-    yield  # La aplicación está ejecutándose
-    
-    # Código de cleanup aquí si es necesario
+# Cola de trabajos en segundo plano (/jobs) y sus workers embebidos
+JOBS = JobStore()
+POOL_WORKERS = PoolWorkers(JOBS)
 
 # Configurar seguridad
 security = HTTPBearer()
 
+# Cortar con 413 las subidas que superan el límite mientras se reciben
+# (se agrega antes que CORS para que la respuesta 413 lleve los encabezados CORS)
+app.add_middleware(LimiteUploadMiddleware)
+
 #enable cors
 origins = ["*"]
 
@@ -194,6 +313,9 @@ app.add_middleware(
 class CowURL(BaseModel):
     url: str
 
+class CowURLBatch(BaseModel):
+    urls: list[str]
+
 # ===== ENDPOINTS DE AUTENTICACIÓN =====
 
 @app.post("/google-login", response_model=AuthResponse)
@@ -388,6 +510,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
 # ===== ENDPOINTS EXISTENTES =====
 
 @app.post("/predict")
+@con_plazo(PLAZO_PETICION_SEGUNDOS)
 async def predict(cow: CowURL):
     # Verificar modo de mantenimiento
     check_maintenance_mode()
@@ -396,23 +519,22 @@ async def predict(cow: CowURL):
     print(f"🔍 Procesando URL en endpoint: {image_url}")
     
     try:
-        # Descargar imagen con timeout y manejo de errores
+        # Descargar la imagen una sola vez con el cliente compartido (límite de tamaño)
         print("📥 Descargando imagen...")
-        response = requests.get(image_url, timeout=10)
-        response.raise_for_status()
-        print(f"✅ Imagen descargada: {len(response.content)} bytes")
+        image_data = await DESCARGADOR.descargar(image_url)
+        print(f"✅ Imagen descargada: {len(image_data)} bytes")
         
-        # Verificar que el contenido no esté vacío
-        if not response.content:
-            raise ValueError("La imagen descargada está vacía")
-        
-        # Verificar que es una imagen válida
+        # Verificar que es una imagen válida; el mismo contexto se usa en todo el pipeline
         print("🖼️ Verificando imagen...")
-        image = Image.open(BytesIO(response.content))
-        image.verify()  # Verifica que sea una imagen válida
+        ctx = await asyncio.to_thread(ImageContext, image_data, image_url)
         print("✅ Imagen válida confirmada")
         
-    except requests.exceptions.RequestException as e:
+    except ImagenDemasiadoGrandeError as e:
+        print(f"❌ Imagen demasiado grande: {e}")
+        raise HTTPException(status_code=413, detail=f"La imagen es demasiado grande: {e}")
+    except PlazoAgotadoError:
+        raise HTTPException(status_code=408, detail="La descarga de la imagen tardó demasiado.")
+    except DescargaError as e:
         print(f"❌ Error descargando imagen: {e}")
         raise HTTPException(status_code=400, detail=f"Error descargando la imagen: {e}")
     except Exception as e:
@@ -423,48 +545,19 @@ async def predict(cow: CowURL):
     try:
         # Analizar imagen con la función de tu IA
         print("🤖 Iniciando análisis con IA...")
-        resultado = analyze_cow_image_with_json_output(image_url)
+        resultado = await analyze_cow_image_with_json_output_async(ctx)
         if not resultado:
             print("❌ La IA no pudo procesar la imagen")
             raise ValueError("No se pudo procesar la imagen con la IA")
         
         # Asegurar que la respuesta tenga todos los campos esperados por el frontend
-        respuesta_completa = {
-            "peso": resultado.get("peso", 400),
-            "precio": resultado.get("precio"),
-            "tamaño": resultado.get("tamaño", "medio"),
-            "condicion": resultado.get("condicion", "buena"),
-            "recomendaciones": resultado.get("recomendaciones", {
-                "nutricion": [
-                    "Mantener dieta balanceada con forraje de calidad",
-                    "Suplementar con sales minerales",
-                    "Proporcionar agua limpia y fresca"
-                ],
-                "manejo": [
-                    "Realizar controles regulares de peso",
-                    "Mantener instalaciones limpias",
-                    "Programar rotación de pasturas"
-                ],
-                "salud": [
-                    "Calendario de vacunación al día",
-                    "Revisión veterinaria periódica",
-                    "Control de parásitos interno y externo"
-                ]
-            }),
-            "metodologia": resultado.get("metodologia"),
-            "peso_openai": resultado.get("peso_openai"),
-            "peso_dataset": resultado.get("peso_dataset"),
-            "peso_original": resultado.get("peso_original"),
-            "factor_correccion_global": resultado.get("factor_correccion_global"),
-            "confianza": resultado.get("confianza"),
-            "observaciones": resultado.get("observaciones"),
-            "dispositivo": resultado.get("dispositivo"),
-            "ajustes_aplicados": resultado.get("ajustes_aplicados")
-        }
+        respuesta_completa = respuesta_prediccion(resultado)
         
         print("✅ Análisis completado exitosamente")
         print("🎯 Respuesta final:", respuesta_completa)
         return respuesta_completa
+    except LLMSaturadoError as e:
+        raise error_modelo_saturado(e)
     except Exception as e:
         print(f"❌ Error procesando imagen con IA: {e}")
         print(f"Tipo de error: {type(e).__name__}")
@@ -473,6 +566,7 @@ async def predict(cow: CowURL):
         raise HTTPException(status_code=500, detail=f"Error procesando la imagen: {e}")
 
 @app.post("/predict-file")
+@con_plazo(PLAZO_PETICION_SEGUNDOS)
 async def predict_file(file: UploadFile = File(...)):
     """Endpoint para analizar imagen enviada como archivo"""
     # Verificar modo de mantenimiento
@@ -485,97 +579,49 @@ async def predict_file(file: UploadFile = File(...)):
     if not file.content_type or not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="El archivo debe ser una imagen")
     
-    # Verificar tamaño del archivo (20MB máximo)
-    MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
-    if file.size and file.size > MAX_FILE_SIZE:
-        raise HTTPException(status_code=413, detail=f"El archivo es demasiado grande. Máximo permitido: {MAX_FILE_SIZE // (1024 * 1024)}MB")
-    
     try:
-        # Leer el contenido del archivo
+        # Leer el contenido del archivo por bloques, con límite de tamaño (20MB máximo)
         print("📖 Leyendo contenido del archivo...")
-        file_content = await file.read()
+        file_content = await leer_upload_limitado(file)
         print(f"✅ Archivo leído: {len(file_content)} bytes")
         
         # Verificar que el archivo no esté vacío
         if not file_content:
             raise ValueError("El archivo está vacío")
         
-        # Verificar que es una imagen válida
+        # Verificar que es una imagen válida y decodificarla una sola vez para todo el pipeline
         print("🖼️ Verificando que es una imagen válida...")
-        image = Image.open(BytesIO(file_content))
-        image.verify()  # Verifica que sea una imagen válida
+        ctx = await asyncio.to_thread(ImageContext, file_content, file.filename)
         print("✅ Imagen válida confirmada")
         
-        # Guardar temporalmente en un archivo para procesar
-        print("💾 Guardando archivo temporal...")
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
-            print(f"✅ Archivo temporal guardado: {temp_file_path}")
-        
+        # Analizar imagen con la función de tu IA con timeout
+        print("🤖 Iniciando análisis con IA...")
         try:
-            # Analizar imagen con la función de tu IA con timeout
-            print("🤖 Iniciando análisis con IA...")
-            try:
-                # Timeout de 4 minutos para el análisis
-                resultado = await asyncio.wait_for(
-                    asyncio.to_thread(analyze_cow_image_with_json_output, temp_file_path),
-                    timeout=240
-                )
-            except asyncio.TimeoutError:
-                print("⏰ Timeout en el análisis de IA")
-                raise HTTPException(status_code=408, detail="El análisis tardó demasiado. Intenta con una imagen más pequeña.")
-            
-            if not resultado:
-                print("❌ La IA no pudo procesar la imagen")
-                raise ValueError("No se pudo procesar la imagen con la IA")
-            
-            # Asegurar que la respuesta tenga todos los campos esperados por el frontend
-            respuesta_completa = {
-                "peso": resultado.get("peso", 400),
-                "precio": resultado.get("precio"),
-                "tamaño": resultado.get("tamaño", "medio"),
-                "condicion": resultado.get("condicion", "buena"),
-                "recomendaciones": resultado.get("recomendaciones", {
-                    "nutricion": [
-                        "Mantener dieta balanceada con forraje de calidad",
-                        "Suplementar con sales minerales",
-                        "Proporcionar agua limpia y fresca"
-                    ],
-                    "manejo": [
-                        "Realizar controles regulares de peso",
-                        "Mantener instalaciones limpias",
-                        "Programar rotación de pasturas"
-                    ],
-                    "salud": [
-                        "Calendario de vacunación al día",
-                        "Revisión veterinaria periódica",
-                        "Control de parásitos interno y externo"
-                    ]
-                }),
-                "metodologia": resultado.get("metodologia"),
-                "peso_openai": resultado.get("peso_openai"),
-                "peso_dataset": resultado.get("peso_dataset"),
-                "peso_original": resultado.get("peso_original"),
-                "factor_correccion_global": resultado.get("factor_correccion_global"),
-                "confianza": resultado.get("confianza"),
-                "observaciones": resultado.get("observaciones"),
-                "dispositivo": resultado.get("dispositivo"),
-                "ajustes_aplicados": resultado.get("ajustes_aplicados")
-            }
-            
-            print("✅ Análisis completado exitosamente")
-            print("🎯 Respuesta final:", respuesta_completa)
-            return respuesta_completa
-            
-        finally:
-            # Limpiar archivo temporal
-            try:
-                os.unlink(temp_file_path)
-                print("🗑️ Archivo temporal eliminado")
-            except:
-                pass
-                
+            # Timeout de 4 minutos como respaldo; el pipeline respeta el plazo de la
+            # petición y devuelve un resultado parcial un poco antes
+            resultado = await asyncio.wait_for(
+                analyze_cow_image_with_json_output_async(ctx),
+                timeout=ANALISIS_TIMEOUT_SEGUNDOS
+            )
+        except asyncio.TimeoutError:
+            print("⏰ Timeout en el análisis de IA")
+            raise HTTPException(status_code=408, detail="El análisis tardó demasiado. Intenta con una imagen más pequeña.")
+        
+        if not resultado:
+            print("❌ La IA no pudo procesar la imagen")
+            raise ValueError("No se pudo procesar la imagen con la IA")
+        
+        # Asegurar que la respuesta tenga todos los campos esperados por el frontend
+        respuesta_completa = respuesta_prediccion(resultado)
+        
+        print("✅ Análisis completado exitosamente")
+        print("🎯 Respuesta final:", respuesta_completa)
+        return respuesta_completa
+        
+    except HTTPException:
+        raise
+    except LLMSaturadoError as e:
+        raise error_modelo_saturado(e)
     except Exception as e:
         print(f"❌ Error procesando archivo: {e}")
         print(f"Tipo de error: {type(e).__name__}")
@@ -583,6 +629,102 @@ async def predict_file(file: UploadFile = File(...)):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error procesando la imagen: {e}")
 
+# Cada cuánto se manda un comentario en los streams SSE para que nginx/Railway no corten la conexión
+SSE_PING_SEGUNDOS = 15.0
+
+@app.post("/predict-file/stream")
+async def predict_file_stream(file: UploadFile = File(...)):
+    """Variante de /predict-file con resultados progresivos por Server-Sent Events
+
+    Eventos: `provisional` (peso y precio solo con el dataset, en milisegundos),
+    `intento` (cada análisis del ensemble al terminar), y al final `resultado`
+    (consenso, mismo formato que /predict-file) o `error`.
+    """
+    from langchain_utils_simulado import ajustar_peso_publicado, calcular_precio_vaca, estimacion_provisional, observar_ensemble
+    
+    # Verificar modo de mantenimiento
+    check_maintenance_mode()
+    
+    if not file.content_type or not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="El archivo debe ser una imagen")
+    
+    # Los errores de la imagen se responden con su código HTTP antes de abrir el stream
+    file_content = await leer_upload_limitado(file)
+    if not file_content:
+        raise HTTPException(status_code=400, detail="El archivo está vacío")
+    try:
+        ctx = await asyncio.to_thread(ImageContext, file_content, file.filename)
+    except Exception as e:
+        print(f"❌ Error validando imagen: {e}")
+        raise HTTPException(status_code=400, detail=f"Imagen inválida: {e}")
+    
+    cola = asyncio.Queue()
+    
+    async def analizar():
+        # El plazo y el observador se fijan dentro de la tarea: su contexto lo heredan los intentos del ensemble
+        with plazo(PLAZO_PETICION_SEGUNDOS), observar_ensemble(cola.put_nowait):
+            return await analyze_cow_image_with_json_output_async(ctx)
+    
+    async def eventos():
+        inicio = time.perf_counter()
+        tarea = asyncio.create_task(analizar())
+        try:
+            provisional = await asyncio.to_thread(estimacion_provisional, ctx)
+            if provisional:
+                provisional["tiempo_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+                yield formato_sse("provisional", provisional)
+            
+            intentos = 0
+            while True:
+                lectura = asyncio.ensure_future(cola.get())
+                hechas, _ = await asyncio.wait({lectura, tarea}, timeout=SSE_PING_SEGUNDOS, return_when=asyncio.FIRST_COMPLETED)
+                if lectura in hechas:
+                    intento = lectura.result()
+                    intentos += 1
+                    peso_modelo, peso = ajustar_peso_publicado(intento["peso"])
+                    yield formato_sse("intento", {
+                        "intento": intentos,
+                        "peso": peso,
+                        "precio": calcular_precio_vaca(peso),
+                        "peso_modelo": peso_modelo,
+                        "peso_openai": intento.get("peso_openai"),
+                        "peso_dataset": intento.get("peso_dataset"),
+                        "confianza": intento.get("confianza"),
+                        "tiempo_ms": round((time.perf_counter() - inicio) * 1000, 1)
+                    })
+                    continue
+                lectura.cancel()
+                if tarea in hechas:
+                    break
+                yield ": ping\n\n"
+            
+            try:
+                resultado = tarea.result()
+            except LLMSaturadoError as e:
+                yield formato_sse("error", {"error": "modelo_saturado", "message": str(e), "retry_after": e.retry_after})
+                return
+            except Exception as e:
+                print(f"❌ Error procesando archivo: {e}")
+                yield formato_sse("error", {"error": type(e).__name__, "message": f"Error procesando la imagen: {e}"})
+                return
+            if not resultado:
+                yield formato_sse("error", {"error": "sin_resultado", "message": "No se pudo procesar la imagen con la IA"})
+                return
+            respuesta = respuesta_prediccion(resultado)
+            respuesta["tiempo_ms"] = round((time.perf_counter() - inicio) * 1000, 1)
+            print("✅ Análisis progresivo completado")
+            yield formato_sse("resultado", respuesta)
+        finally:
+            # Si el cliente se desconecta se cancela el análisis (salvo que otra petición lo comparta)
+            if not tarea.done():
+                tarea.cancel()
+    
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/predict-multipart")
 async def predict_multipart(file: UploadFile = File(...)):
     """Endpoint alternativo para analizar imagen enviada como multipart/form-data"""
@@ -591,6 +733,232 @@ async def predict_multipart(file: UploadFile = File(...)):
     
     return await predict_file(file)
 
+# ===== PREDICCIÓN POR LOTES =====
+
+# Configuración de /predict-batch: la concurrencia es global (compartida por todos los lotes en curso)
+BATCH_CONFIG = {
+    'max_concurrencia': int(os.getenv("BATCH_MAX_CONCURRENCIA", "4")),
+    'max_items': int(os.getenv("BATCH_MAX_ITEMS", "200")),
+}
+SEMAFORO_BATCH = asyncio.Semaphore(BATCH_CONFIG['max_concurrencia'])
+
+async def _items_del_lote(request: Request):
+    """Lista de (nombre, fuente) del lote: URLs (JSON) o archivos subidos (multipart, campo `files`)
+
+    Los archivos quedan en archivos temporales y se leen recién cuando su ítem
+    entra a analizarse, así la memoria depende de la concurrencia y no del lote.
+    """
+    tipo = request.headers.get("content-type", "")
+    if tipo.startswith("application/json"):
+        try:
+            lote = CowURLBatch(**await request.json())
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Se esperaba {{\"urls\": [...]}}: {e}")
+        items = [(url, url) for url in lote.urls]
+    elif tipo.startswith("multipart/form-data"):
+        form = await leer_form_limitado(request, en_memoria=False, max_files=BATCH_CONFIG['max_items'])
+        items = [(archivo.filename, archivo) for archivo in form.getlist("files") if hasattr(archivo, "read")]
+        for nombre, archivo in items:
+            if not archivo.content_type or not archivo.content_type.startswith('image/'):
+                await form.close()
+                raise HTTPException(status_code=400, detail=f"{nombre}: el archivo debe ser una imagen")
+    else:
+        raise HTTPException(status_code=415, detail="Envía JSON con `urls` o multipart/form-data con `files`")
+    
+    if not items:
+        raise HTTPException(status_code=400, detail="El lote está vacío")
+    if len(items) > BATCH_CONFIG['max_items']:
+        raise HTTPException(status_code=400, detail=f"Máximo {BATCH_CONFIG['max_items']} imágenes por lote")
+    return items
+
+async def _procesar_item_lote(indice: int, nombre: str, fuente):
+    """Analiza una imagen del lote; nunca lanza: los errores van en la línea del ítem"""
+    inicio = time.perf_counter()
+    async with SEMAFORO_BATCH:
+        espera_ms = (time.perf_counter() - inicio) * 1000
+        inicio_analisis = time.perf_counter()
+        linea = {"indice": indice, "nombre": nombre}
+        try:
+            # El plazo de cada imagen corre desde que entra a analizarse, no desde que llegó el lote
+            with plazo(PLAZO_PETICION_SEGUNDOS):
+                # Las URLs se descargan con el cliente HTTP compartido; las imágenes repetidas
+                # en el lote se coalescen por contenido
+                if isinstance(fuente, str):
+                    datos = await DESCARGADOR.descargar(fuente)
+                else:
+                    datos = await leer_upload_limitado(fuente)
+                    await fuente.close()
+                ctx = await asyncio.to_thread(ImageContext, datos, nombre)
+                resultado = await analyze_cow_image_with_json_output_async(ctx)
+            if not resultado:
+                raise ValueError("No se pudo procesar la imagen con la IA")
+            linea.update({"ok": True, "resultado": respuesta_prediccion(resultado)})
+        except LLMSaturadoError as e:
+            linea.update({"ok": False, "status": 503, "error": str(e), "retry_after": e.retry_after})
+        except ImagenDemasiadoGrandeError as e:
+            linea.update({"ok": False, "status": 413, "error": f"La imagen es demasiado grande: {e}"})
+        except PlazoAgotadoError as e:
+            linea.update({"ok": False, "status": 408, "error": str(e)})
+        except DescargaError as e:
+            linea.update({"ok": False, "status": 400, "error": f"Error descargando la imagen: {e}"})
+        except Exception as e:
+            print(f"❌ Error en el ítem {indice} del lote ({nombre}): {e}")
+            linea.update({"ok": False, "status": 500, "error": f"{type(e).__name__}: {e}"})
+    linea["espera_ms"] = round(espera_ms, 1)
+    linea["tiempo_ms"] = round((time.perf_counter() - inicio_analisis) * 1000, 1)
+    return linea
+
+@app.post("/predict-batch")
+async def predict_batch(request: Request):
+    """Analiza un lote de imágenes (JSON `{"urls": [...]}` o multipart con varios `files`)
+
+    Responde NDJSON: una línea por imagen en el orden en que terminan (con `indice`
+    para ubicarla en el lote, tiempos y resultado o error) y una última línea
+    `resumen` con el throughput del lote.
+    """
+    from langchain_utils_simulado import obtener_dataset_snapshot
+    
+    # Verificar modo de mantenimiento
+    check_maintenance_mode()
+    
+    items = await _items_del_lote(request)
+    print(f"📦 Lote de {len(items)} imágenes ({BATCH_CONFIG['max_concurrencia']} en paralelo)")
+    
+    # Cargar el índice del dataset una vez antes de que los ítems lo usen en paralelo
+    await asyncio.to_thread(obtener_dataset_snapshot)
+    
+    async def lineas():
+        inicio = time.perf_counter()
+        tareas = [
+            asyncio.create_task(_procesar_item_lote(indice, nombre, fuente))
+            for indice, (nombre, fuente) in enumerate(items)
+        ]
+        tiempos = []
+        exitosos = 0
+        try:
+            for siguiente in asyncio.as_completed(tareas):
+                linea = await siguiente
+                tiempos.append(linea["tiempo_ms"])
+                exitosos += linea["ok"]
+                yield json.dumps(linea, ensure_ascii=False, default=str) + "\n"
+        finally:
+            # Cliente desconectado: no seguir gastando en el resto del lote
+            for tarea in tareas:
+                tarea.cancel()
+            for _, fuente in items:
+                if not isinstance(fuente, str):
+                    await fuente.close()
+        
+        import numpy as np
+        total_s = time.perf_counter() - inicio
+        resumen = {
+            "total": len(items),
+            "exitosos": exitosos,
+            "fallidos": len(items) - exitosos,
+            "tiempo_total_s": round(total_s, 2),
+            "imagenes_por_minuto": round(len(items) / total_s * 60, 2) if total_s > 0 else None,
+            "latencia_promedio_ms": round(float(np.mean(tiempos)), 1),
+            "latencia_p95_ms": round(float(np.percentile(tiempos, 95)), 1),
+            "max_concurrencia": BATCH_CONFIG['max_concurrencia']
+        }
+        print(f"📦 Lote terminado: {exitosos}/{len(items)} en {total_s:.1f}s")
+        yield json.dumps({"resumen": resumen}, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(lineas(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+# ===== TRABAJOS EN SEGUNDO PLANO =====
+
+# Cada cuánto se consulta el estado del trabajo para los eventos SSE
+JOBS_SSE_CONSULTA_SEGUNDOS = 1.0
+
+def vista_job(trabajo: dict) -> dict:
+    """Estado del trabajo para el cliente (el resultado con el formato de /predict)"""
+    vista = {
+        "job_id": trabajo["id"],
+        "estado": trabajo["estado"],
+        "posicion_en_cola": trabajo["posicion_en_cola"],
+        "intentos": trabajo["intentos"],
+        "creado_en": trabajo["creado_en"],
+        "iniciado_en": trabajo["iniciado_en"],
+        "terminado_en": trabajo["terminado_en"],
+        "error": trabajo["error"],
+    }
+    if trabajo["estado"] == COMPLETADO:
+        vista["resultado"] = respuesta_prediccion(trabajo["resultado"])
+    return vista
+
+@app.post("/jobs", status_code=202)
+async def crear_job(file: UploadFile = File(None), url: str = Form(None)):
+    """Encola un análisis (archivo o URL) y devuelve el id del trabajo de inmediato"""
+    # Verificar modo de mantenimiento
+    check_maintenance_mode()
+    
+    if file is None and not url:
+        raise HTTPException(status_code=400, detail="Envía un archivo de imagen o una URL")
+    
+    if file is not None:
+        if not file.content_type or not file.content_type.startswith('image/'):
+            raise HTTPException(status_code=400, detail="El archivo debe ser una imagen")
+        contenido = await leer_upload_limitado(file)
+        if not contenido:
+            raise HTTPException(status_code=400, detail="El archivo está vacío")
+        job_id = await asyncio.to_thread(JOBS.crear, imagen=contenido, nombre=file.filename)
+    else:
+        # La descarga la hace el worker
+        job_id = await asyncio.to_thread(JOBS.crear, url=url)
+    
+    print(f"📨 Trabajo {job_id} encolado")
+    return {
+        "job_id": job_id,
+        "estado": "pendiente",
+        "estado_url": f"/jobs/{job_id}",
+        "eventos_url": f"/jobs/{job_id}/events"
+    }
+
+@app.get("/jobs/{job_id}")
+async def obtener_job(job_id: str):
+    """Estado del trabajo y, cuando terminó, su resultado (para consultar por polling)"""
+    trabajo = await asyncio.to_thread(JOBS.obtener, job_id)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    return vista_job(trabajo)
+
+@app.get("/jobs/{job_id}/events")
+async def eventos_job(job_id: str):
+    """Server-Sent Events con cada cambio de estado del trabajo; termina con `resultado` o `error`"""
+    trabajo = await asyncio.to_thread(JOBS.obtener, job_id)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    
+    async def eventos():
+        actual = trabajo
+        ultimo_estado = None
+        ultimo_envio = time.monotonic()
+        while True:
+            if actual is None:
+                yield formato_sse("error", {"job_id": job_id, "error": "Trabajo no encontrado"})
+                return
+            vista = vista_job(actual)
+            if actual["estado"] in ESTADOS_FINALES:
+                yield formato_sse("resultado" if actual["estado"] == COMPLETADO else "error", vista)
+                return
+            if actual["estado"] != ultimo_estado:
+                ultimo_estado = actual["estado"]
+                ultimo_envio = time.monotonic()
+                yield formato_sse("estado", vista)
+            elif time.monotonic() - ultimo_envio >= SSE_PING_SEGUNDOS:
+                ultimo_envio = time.monotonic()
+                yield ": ping\n\n"
+            await asyncio.sleep(JOBS_SSE_CONSULTA_SEGUNDOS)
+            actual = await asyncio.to_thread(JOBS.obtener, job_id)
+    
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        # Sin buffer en nginx para que cada evento llegue en cuanto se genera
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/test")
 async def test_endpoint():
     """Endpoint de prueba simple"""
@@ -630,6 +998,7 @@ async def test_analysis():
         return {"error": f"Error en analisis de prueba: {str(e)}"}
 
 @app.post("/calibrate-weight")
+@con_plazo(PLAZO_PETICION_SEGUNDOS)
 async def calibrate_weight(file: UploadFile = File(...), peso_real: int = None):
     """Endpoint para calibrar el modelo con peso real conocido"""
     print(f"🔧 Calibrando modelo con peso real: {peso_real} kg")
@@ -642,27 +1011,18 @@ async def calibrate_weight(file: UploadFile = File(...), peso_real: int = None):
         raise HTTPException(status_code=400, detail="El archivo debe ser una imagen")
     
     try:
-        # Leer el contenido del archivo
-        file_content = await file.read()
+        # Leer el contenido del archivo con límite de tamaño
+        file_content = await leer_upload_limitado(file)
         
         if not file_content:
             raise ValueError("El archivo está vacío")
         
-        # Verificar que es una imagen válida
-        image = Image.open(BytesIO(file_content))
-        image.verify()
-        
-        # Guardar temporalmente
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-            temp_file.write(file_content)
-            temp_path = temp_file.name
+        # Verificar que es una imagen válida (en memoria, sin archivo temporal)
+        ctx = await asyncio.to_thread(ImageContext, file_content, file.filename)
         
         # Realizar calibración
-        from langchain_utils_simulado import calibrate_weight_estimation
-        resultado_calibrado = calibrate_weight_estimation(temp_path, peso_real)
-        
-        # Limpiar archivo temporal
-        os.unlink(temp_path)
+        from langchain_utils_simulado import calibrate_weight_estimation_async
+        resultado_calibrado = await calibrate_weight_estimation_async(ctx, peso_real)
         
         if resultado_calibrado:
             return {
@@ -675,6 +1035,10 @@ async def calibrate_weight(file: UploadFile = File(...), peso_real: int = None):
         else:
             raise HTTPException(status_code=500, detail="Error en la calibración")
             
+    except HTTPException:
+        raise
+    except LLMSaturadoError as e:
+        raise error_modelo_saturado(e)
     except Exception as e:
         print(f"❌ Error en calibración: {e}")
         raise HTTPException(status_code=500, detail=f"Error en calibración: {str(e)}")
@@ -727,6 +1091,7 @@ async def test_ai_free():
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 @app.get("/test-ai-analysis/{image_id}")
+@con_plazo(PLAZO_PETICION_SEGUNDOS)
 async def test_ai_analysis(image_id: str):
     """
     Analiza una imagen específica del dataset para probar la IA gratis
@@ -743,33 +1108,25 @@ async def test_ai_analysis(image_id: str):
         
         print(f"🔍 Analizando imagen de prueba: {image_id}")
         
-        # Leer la imagen
-        with open(image_path, "rb") as image_file:
-            image_data = image_file.read()
+        # Leer la imagen directamente del dataset
+        ctx = await asyncio.to_thread(ImageContext.from_path, image_path)
         
-        # Crear un archivo temporal para simular upload
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-            temp_file.write(image_data)
-            temp_path = temp_file.name
+        # Analizar la imagen
+        result = await analyze_cow_image_with_json_output_async(ctx)
         
-        try:
-            # Analizar la imagen
-            result = analyze_cow_image_with_json_output(temp_path)
-            
-            return {
-                "success": True,
-                "message": f"✅ Análisis completado para {image_id}",
-                "image_id": image_id,
-                "analysis": result,
-                "test_mode": True,
-                "note": "Esta es una imagen del dataset integrado con medidas reales"
-            }
-            
-        finally:
-            # Limpiar archivo temporal
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
+        return {
+            "success": True,
+            "message": f"✅ Análisis completado para {image_id}",
+            "image_id": image_id,
+            "analysis": result,
+            "test_mode": True,
+            "note": "Esta es una imagen del dataset integrado con medidas reales"
+        }
                 
+    except HTTPException:
+        raise
+    except LLMSaturadoError as e:
+        raise error_modelo_saturado(e)
     except Exception as e:
         print(f"❌ Error en análisis de prueba: {e}")
         raise HTTPException(status_code=500, detail=f"Error en análisis: {str(e)}")
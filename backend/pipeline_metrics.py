@@ -0,0 +1,58 @@
+"""
+Métricas en memoria del pipeline de predicción.
+
+Agrupa contadores y latencias por una clave (por ejemplo la configuración de
+preprocesamiento de imagen) para poder comparar variantes en producción.
+"""
+
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class MetricasPorClave:
+    """Contadores acumulados y ventana de latencias recientes por clave"""
+
+    def __init__(self, max_muestras: int = 500):
+        self.max_muestras = max_muestras
+        self._lock = threading.Lock()
+        self._grupos = {}
+
+    def registrar(self, clave: str, latencia_ms: float = None, **valores):
+        """Suma una observación: latencia opcional y valores numéricos a acumular"""
+        with self._lock:
+            grupo = self._grupos.get(clave)
+            if grupo is None:
+                grupo = {"n": 0, "sumas": {}, "latencias": deque(maxlen=self.max_muestras)}
+                self._grupos[clave] = grupo
+            grupo["n"] += 1
+            for nombre, valor in valores.items():
+                grupo["sumas"][nombre] = grupo["sumas"].get(nombre, 0) + valor
+            if latencia_ms is not None:
+                grupo["latencias"].append(latencia_ms)
+
+    def resumen(self) -> dict:
+        """Totales, promedios y percentiles de latencia de cada clave"""
+        with self._lock:
+            resumen = {}
+            for clave, grupo in self._grupos.items():
+                n = grupo["n"]
+                entrada = {"n": n}
+                for nombre, suma in grupo["sumas"].items():
+                    entrada[f"{nombre}_total"] = suma
+                    entrada[f"{nombre}_promedio"] = round(suma / n, 2)
+                if grupo["latencias"]:
+                    latencias = np.array(grupo["latencias"])
+                    entrada["latencia_ms"] = {
+                        "muestras": len(latencias),
+                        "promedio": round(float(latencias.mean()), 1),
+                        "p50": round(float(np.percentile(latencias, 50)), 1),
+                        "p90": round(float(np.percentile(latencias, 90)), 1),
+                    }
+                resumen[clave] = entrada
+            return resumen
+
+    def reset(self):
+        with self._lock:
+            self._grupos.clear()
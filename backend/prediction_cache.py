@@ -0,0 +1,178 @@
+"""
+Caché de predicciones direccionada por contenido.
+
+La clave es el SHA-256 de los bytes de la imagen más la versión del pipeline
+(que incluye los parámetros de calibración). Tiene dos niveles:
+
+- memoria: LRU acotado con expiración (TTL)
+- disco: SQLite, para que los aciertos sobrevivan a reinicios
+
+Cuando aparece una versión nueva (p. ej. tras una calibración) las entradas
+de versiones anteriores se eliminan una sola vez; si después siguen llegando
+peticiones con una versión ya vista (cambio de configuración en curso) sus
+entradas conviven y las antiguas vencen por TTL/LRU.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def _a_json(valor):
+    """Serializa tipos de numpy que puedan venir en el resultado"""
+    if hasattr(valor, "item"):
+        return valor.item()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+def serializar_resultado(resultado: dict) -> str:
+    """JSON de un resultado de predicción (la caché y la cola de trabajos lo guardan así)"""
+    return json.dumps(resultado, ensure_ascii=False, default=_a_json)
+
+
+class PredictionCache:
+    """Caché LRU+TTL en memoria con respaldo opcional en SQLite"""
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 86400, db_path: str = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict()  # (sha256, version) -> (expira_en, json)
+        self._version_actual = None
+        self._versiones_vistas = set()
+        self._db = None
+
+        # Contadores para dimensionar la caché
+        self.hits_memoria = 0
+        self.hits_disco = 0
+        self.misses = 0
+        self.escrituras = 0
+        self.expirados = 0
+        self.invalidaciones = 0
+
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    """CREATE TABLE IF NOT EXISTS predicciones (
+                        sha256 TEXT NOT NULL,
+                        version TEXT NOT NULL,
+                        expira_en REAL NOT NULL,
+                        resultado TEXT NOT NULL,
+                        PRIMARY KEY (sha256, version)
+                    )"""
+                )
+                self._db.commit()
+                print(f"✅ Caché de predicciones en disco: {db_path}")
+            except Exception as e:
+                print(f"⚠️ Caché en disco no disponible ({e}), usando solo memoria")
+                self._db = None
+
+    def _verificar_version(self, version):
+        """Elimina entradas de versiones anteriores la primera vez que aparece una versión"""
+        if version == self._version_actual or version in self._versiones_vistas:
+            return
+        self._versiones_vistas.add(version)
+        if self._version_actual is not None:
+            print(f"🔄 Versión de calibración cambió, invalidando caché ({self._version_actual} → {version})")
+            self.invalidaciones += 1
+        self._version_actual = version
+        for clave in [c for c in self._memoria if c[1] != version]:
+            del self._memoria[clave]
+        if self._db is not None:
+            self._db.execute("DELETE FROM predicciones WHERE version != ?", (version,))
+            self._db.commit()
+
+    def get(self, sha256: str, version: str):
+        """Devuelve una copia del resultado cacheado o None"""
+        clave = (sha256, version)
+        ahora = time.time()
+        with self._lock:
+            self._verificar_version(version)
+
+            entrada = self._memoria.get(clave)
+            if entrada is not None:
+                expira_en, resultado = entrada
+                if expira_en > ahora:
+                    self._memoria.move_to_end(clave)
+                    self.hits_memoria += 1
+                    return json.loads(resultado)
+                del self._memoria[clave]
+                self.expirados += 1
+
+            if self._db is not None:
+                fila = self._db.execute(
+                    "SELECT expira_en, resultado FROM predicciones WHERE sha256 = ? AND version = ?",
+                    clave,
+                ).fetchone()
+                if fila is not None:
+                    expira_en, resultado = fila
+                    if expira_en > ahora:
+                        self._guardar_en_memoria(clave, expira_en, resultado)
+                        self.hits_disco += 1
+                        return json.loads(resultado)
+                    self._db.execute("DELETE FROM predicciones WHERE sha256 = ? AND version = ?", clave)
+                    self._db.commit()
+                    self.expirados += 1
+
+            self.misses += 1
+            return None
+
+    def set(self, sha256: str, version: str, resultado: dict):
+        """Guarda un resultado en memoria y en disco"""
+        clave = (sha256, version)
+        expira_en = time.time() + self.ttl_seconds
+        serializado = serializar_resultado(resultado)
+        with self._lock:
+            self._verificar_version(version)
+            self._guardar_en_memoria(clave, expira_en, serializado)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO predicciones (sha256, version, expira_en, resultado) VALUES (?, ?, ?, ?)",
+                    (sha256, version, expira_en, serializado),
+                )
+                self._db.commit()
+            self.escrituras += 1
+
+    def _guardar_en_memoria(self, clave, expira_en, serializado):
+        self._memoria[clave] = (expira_en, serializado)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_entries:
+            self._memoria.popitem(last=False)
+
+    def clear(self):
+        """Vacía ambos niveles de la caché"""
+        with self._lock:
+            self._memoria.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM predicciones")
+                self._db.commit()
+            self.invalidaciones += 1
+
+    def stats(self) -> dict:
+        """Contadores de aciertos/fallos y ocupación"""
+        with self._lock:
+            entradas_disco = None
+            if self._db is not None:
+                entradas_disco = self._db.execute("SELECT COUNT(*) FROM predicciones").fetchone()[0]
+            hits = self.hits_memoria + self.hits_disco
+            consultas = hits + self.misses
+            return {
+                "hits": hits,
+                "hits_memoria": self.hits_memoria,
+                "hits_disco": self.hits_disco,
+                "misses": self.misses,
+                "hit_rate": round(hits / consultas, 4) if consultas else 0.0,
+                "escrituras": self.escrituras,
+                "expirados": self.expirados,
+                "invalidaciones": self.invalidaciones,
+                "entradas_memoria": len(self._memoria),
+                "entradas_disco": entradas_disco,
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "version": self._version_actual,
+            }
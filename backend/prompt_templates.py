@@ -0,0 +1,215 @@
+"""
+Plantillas versionadas del prompt de análisis de peso.
+
+El texto fijo (persona, ejemplos, metodología, instrucciones y formato de
+respuesta) se arma una sola vez por versión y va al principio del mensaje,
+idéntico en todas las peticiones, para que el proveedor lo reutilice con su
+caché de prefijos. Lo que cambia va al final: el contexto del dataset (solo
+cambia al recargarlo) y la pista del dataset de cada petición.
+
+Versiones:
+- completo-v1: Chain of Thought documentado paso a paso (formato original)
+- compacto-v1: mismos pasos razonados internamente y respuesta JSON mínima
+"""
+
+from structured_output import (
+    AnalisisPeso, AnalisisPesoAutocorregido, AnalisisPesoCompacto, AnalisisPesoCompactoAutocorregido
+)
+
+# Datos de contexto con ejemplos
+EXAMPLES = """
+- Vaca 1: imagen_url=https://drive.google.com/uc?id=12ygJabwRTon0DoVliundkso-35w_ILxO, peso=378 kg
+- Vaca 2: imagen_url=https://drive.google.com/uc?id=1p9zqcP2DeUEx993fjqnR6HrzJF5r_rix, peso=446 kg
+- Vaca 3: imagen_url=https://drive.google.com/uc?id=1DwLycAIur8Hc1Beda3DQiYqMSOGucHQW, peso=487 kg
+- Vaca 4: imagen_url=https://drive.google.com/uc?id=1BduYhTPpvPnQdf9hb9Mudaj9hCY9BW0d, peso=457 kg
+- Vaca 5: imagen_url=https://drive.google.com/uc?id=1QEcgPxSGrtQubaiOPdkFKpSFJaeMCZ_q, peso=389 kg
+- Vaca 6: imagen_url=https://drive.google.com/uc?id=1ftGFRdg5G3nCLyd_Xuyn80wfwzYmhFLY, peso=410 kg
+- Vaca 7: imagen_url=https://drive.google.com/uc?id=1p4izPVn180TetlxOxwm6GW4_PEf-8qtN, peso=429 kg
+- Vaca 8: imagen_url=https://drive.google.com/uc?id=1UwbKMJ0RcgNVj2XqKIP4BcQtS9fhe4o5, peso=514 kg
+- Vaca 9: imagen_url=https://drive.google.com/uc?id=1vRl6QdmhJrF4TKGcbxHhmQSQKDu3dWiF, peso=459 kg
+"""
+
+PERSONA = """Eres un veterinario experto en ganado bovino con 25 años de experiencia especializado en estimación de peso corporal. Usa el método CHAIN OF THOUGHT para análisis paso a paso."""
+
+METODOLOGIA = """🎯 METODOLOGÍA CHAIN OF THOUGHT (PASO A PASO):
+
+**PASO 1: ANÁLISIS DIMENSIONAL**
+Examina y describe en detalle:
+- Longitud corporal (hombro a cadera): corta/media/larga
+- Altura al hombro: baja/media/alta  
+- Ancho del cuerpo (vista lateral): delgado/medio/robusto
+- Profundidad del pecho: poco/medio/muy desarrollado
+
+**PASO 2: EVALUACIÓN DE CONDICIÓN CORPORAL**
+Observa y clasifica:
+- Visibilidad de costillas: muy visible/apenas visible/no visible
+- Desarrollo muscular: bajo/medio/alto/muy alto
+- Acumulación de grasa: ninguna/poca/moderada/abundante
+- Estado general: delgada/media/buena/excelente
+
+**PASO 3: COMPARACIÓN CON REFERENCIAS**
+Compara con el dataset de referencia:
+- Encuentra la vaca más similar en el dataset
+- Identifica diferencias clave
+- Ajusta el peso base según diferencias observadas
+
+**PASO 4: CÁLCULO DE PESO BASE**
+Basándote en dimensiones:
+- Vaca pequeña (300-350 kg): longitud corta + altura baja + cuerpo delgado
+- Vaca mediana (350-450 kg): dimensiones proporcionadas medias
+- Vaca grande (450-550 kg): longitud larga + altura alta + cuerpo robusto
+- Vaca muy grande (550+ kg): todas las dimensiones máximas + muy robusto
+
+**PASO 5: AJUSTES POR CONDICIÓN**
+Aplica factores de corrección:
+- Condición delgada: peso_base × 0.90 (-10%)
+- Condición media: peso_base × 1.00 (sin cambio)
+- Condición buena: peso_base × 1.10 (+10%)
+- Condición excelente: peso_base × 1.15 (+15%)
+
+**PASO 6: AJUSTE FINAL POR CONFIANZA**
+Considera factores de calidad de imagen:
+- Imagen clara, ángulo lateral perfecto: sin ajuste
+- Imagen aceptable, ligera angulación: ±5% incertidumbre
+- Imagen pobre, ángulo no ideal: ±10% incertidumbre
+
+**PASO 7: VERIFICACIÓN DE REALISMO**
+Revisa la estimación final:
+- ¿Está dentro del rango típico (300-700 kg)?
+- ¿Es consistente con la condición observada?
+- ¿Coincide con vacas similares del dataset?
+
+⚠️ CORRECCIÓN CRÍTICA PARA SUBESTIMACIÓN:
+Si la vaca muestra signos de peso alto (>450kg estimado):
+- Músculos muy desarrollados: +30-50 kg adicionales
+- Contextura excepcionalmente robusta: +50-80 kg adicionales
+- Comparación con dataset muestra subestimación: +40-100 kg
+"""
+
+INSTRUCCIONES_FINALES_COMPLETO = """🎯 INSTRUCCIONES FINALES:
+1. Sigue TODOS los pasos en orden
+2. Documenta tu razonamiento en cada paso
+3. Muestra los cálculos intermedios
+4. Proporciona peso final con alta confianza
+"""
+
+INSTRUCCIONES_FINALES_COMPACTO = """🎯 INSTRUCCIONES FINALES:
+1. Sigue TODOS los pasos en orden, pero razónalos internamente: no escribas el desarrollo
+2. Proporciona peso final con alta confianza
+3. Responde ÚNICAMENTE con el JSON, sin texto antes ni después
+"""
+
+FORMATO_COMPLETO = """RESPONDE EN FORMATO JSON con tu análisis paso a paso:
+
+```json
+{{
+    "paso1_dimensiones": "descripción detallada",
+    "paso2_condicion": "descripción detallada",
+    "paso3_referencia_similar": "vaca del dataset más similar y peso",
+    "paso4_peso_base": número_kg,
+    "paso5_factor_condicion": número_decimal,
+    "paso6_peso_ajustado": número_kg,
+    "paso7_ajuste_final": número_kg,{campos_autocorreccion}
+    "peso": número_final_en_kg,
+    "condicion": "delgada/media/buena/excelente",
+    "confianza": "alta/media/baja",
+    "observaciones": "resumen del análisis paso a paso",
+    "metodologia": "Chain of Thought - Análisis Sistemático Paso a Paso"
+}}
+```"""
+
+FORMATO_COMPACTO = """RESPONDE SOLO CON ESTE JSON:
+
+```json
+{{{campos_autocorreccion}
+    "peso": número_final_en_kg,
+    "condicion": "delgada/media/buena/excelente",
+    "confianza": "alta/media/baja",
+    "observaciones": "una frase con lo que más influyó en el peso"
+}}
+```"""
+
+# Instrucciones que se agregan al prompt en el modo de autocorrección integrada
+INSTRUCCIONES_AUTOCORRECCION_INTEGRADA = """
+🧠 AUTOCORRECCIÓN EN LA MISMA RESPUESTA:
+Tu peso del PASO 7 es tu predicción inicial. En vacas de contextura grande solemos ver una
+subestimación sistemática, así que si esa predicción inicial es de 450 kg o más revísala:
+- Vacas con contextura grande: peso real suele ser 30-40kg mayor
+- Vacas con músculos desarrollados: considerar peso adicional por masa muscular
+- Vacas adultas en buen estado: peso real puede ser significativamente mayor
+Informa la predicción inicial en "peso_inicial" y la revisada en "peso_corregido"
+(igual a la inicial si es menor a 450 kg o no corresponde ajustar). "peso" debe ser igual a "peso_corregido".
+"""
+
+CAMPOS_AUTOCORRECCION_INTEGRADA = """
+    "peso_inicial": número_kg_del_paso7,
+    "peso_corregido": número_entero_en_kg,
+    "factor_correccion": "razón_del_ajuste","""
+
+CAMPOS_AUTOCORRECCION_COMPACTO = """
+    "peso_inicial": número_kg_antes_de_revisar,
+    "peso_corregido": número_entero_en_kg,
+    "factor_correccion": "razón_del_ajuste","""
+
+PROMPT_VERSIONES = {
+    'completo-v1': {
+        'instrucciones': INSTRUCCIONES_FINALES_COMPLETO,
+        'formato': FORMATO_COMPLETO,
+        'campos_autocorreccion': CAMPOS_AUTOCORRECCION_INTEGRADA,
+        'esquema': AnalisisPeso,
+        'esquema_autocorregido': AnalisisPesoAutocorregido,
+    },
+    'compacto-v1': {
+        'instrucciones': INSTRUCCIONES_FINALES_COMPACTO,
+        'formato': FORMATO_COMPACTO,
+        'campos_autocorreccion': CAMPOS_AUTOCORRECCION_COMPACTO,
+        'esquema': AnalisisPesoCompacto,
+        'esquema_autocorregido': AnalisisPesoCompactoAutocorregido,
+    },
+}
+
+VERSION_POR_DEFECTO = 'completo-v1'
+
+# Prefijos ya armados: (versión, autocorrección integrada) -> texto
+_PREFIJOS = {}
+
+
+def obtener_version(version: str) -> dict:
+    """Definición de la versión pedida (ValueError si no existe)"""
+    if version not in PROMPT_VERSIONES:
+        raise ValueError(f"Versión de prompt desconocida: {version} (disponibles: {', '.join(PROMPT_VERSIONES)})")
+    return PROMPT_VERSIONES[version]
+
+
+def prefijo_prompt(version: str, autocorreccion_integrada: bool = False) -> str:
+    """Parte fija del prompt; se construye una vez por versión y modo"""
+    clave = (version, autocorreccion_integrada)
+    prefijo = _PREFIJOS.get(clave)
+    if prefijo is None:
+        definicion = obtener_version(version)
+        campos = definicion['campos_autocorreccion'] if autocorreccion_integrada else ""
+        instrucciones = INSTRUCCIONES_AUTOCORRECCION_INTEGRADA if autocorreccion_integrada else ""
+        prefijo = (
+            f"{PERSONA}\n\n"
+            f"DATOS DE REFERENCIA PARA CALIBRACIÓN:\n{EXAMPLES}\n"
+            f"{METODOLOGIA}\n"
+            f"{definicion['instrucciones']}"
+            f"{instrucciones}\n"
+            f"{definicion['formato'].format(campos_autocorreccion=campos)}"
+        )
+        _PREFIJOS[clave] = prefijo
+    return prefijo
+
+
+def sufijo_prompt(dataset_context: str, peso_dataset=None) -> str:
+    """Parte variable del prompt: dataset de referencia y pista del dataset para esta imagen"""
+    sufijo = f"\n{dataset_context}" if dataset_context else ""
+    if peso_dataset:
+        sufijo += f"\n- Contexto adicional para la autocorrección: Dataset sugiere {peso_dataset}kg\n"
+    return sufijo
+
+
+def esquema_respuesta(version: str, autocorreccion_integrada: bool = False):
+    """Modelo Pydantic de la respuesta de esta versión"""
+    definicion = obtener_version(version)
+    return definicion['esquema_autocorregido'] if autocorreccion_integrada else definicion['esquema']
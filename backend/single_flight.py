@@ -0,0 +1,120 @@
+"""
+Coalescencia de peticiones idénticas (single-flight).
+
+Si llega una petición cuya clave (hash de la imagen o URL normalizada) ya
+tiene un análisis en curso, espera ese mismo análisis en lugar de lanzar
+otro ensemble completo. El análisis se cancela solo si todas las peticiones
+que lo esperaban se cancelan.
+
+La ejecución compartida corre en un contexto vacío, no en el de la primera
+petición. Las variables de contexto registradas en `variables` (plazo de la
+petición, observador del ensemble) toman ahí un `ValorCompartido`, que combina
+los valores de todas las peticiones que siguen esperando.
+"""
+
+import asyncio
+import contextvars
+import copy
+import itertools
+import threading
+
+
+class ValorCompartido:
+    """Valor de una variable de contexto en la ejecución compartida: combina el de cada petición que espera"""
+
+    def __init__(self, combinar):
+        self._combinar = combinar  # lista de valores de las peticiones -> valor efectivo
+        self._valores = {}
+
+    def agregar(self, espera, valor):
+        self._valores[espera] = valor
+
+    def quitar(self, espera):
+        self._valores.pop(espera, None)
+
+    def valor(self):
+        # Un análisis compartido dentro de otro (URL -> contenido) sigue viendo los valores vigentes del externo
+        return self._combinar([v.valor() if isinstance(v, ValorCompartido) else v for v in self._valores.values()])
+
+
+def valor_actual(variable: contextvars.ContextVar):
+    """Valor de la variable en el contexto actual, resolviendo el combinado si es una ejecución compartida"""
+    valor = variable.get()
+    if isinstance(valor, ValorCompartido):
+        return valor.valor()
+    return valor
+
+
+class SingleFlight:
+    """Comparte una única ejecución en curso entre todas las peticiones con la misma clave"""
+
+    def __init__(self, variables: dict = None):
+        self._lock = threading.Lock()
+        self._en_vuelo = {}  # (loop, clave) -> [tarea, peticiones esperando, {variable: ValorCompartido}]
+        self._variables = variables or {}  # ContextVar -> función que combina los valores de las peticiones
+        self._esperas = itertools.count()
+        self.lideres = 0
+        self.coalescidas = 0
+
+    async def ejecutar(self, clave, fabrica):
+        """Ejecuta `fabrica()` o se une a la ejecución en curso con la misma clave"""
+        loop = asyncio.get_running_loop()
+        clave_loop = (loop, clave)  # Las tareas solo se comparten dentro del mismo event loop
+
+        espera = next(self._esperas)
+        with self._lock:
+            vuelo = self._en_vuelo.get(clave_loop)
+            lider = vuelo is None
+            if lider:
+                # Contexto neutro: el plazo y el observador salen de todas las peticiones, no solo de la primera
+                contexto = contextvars.Context()
+                compartidos = {variable: ValorCompartido(combinar) for variable, combinar in self._variables.items()}
+                for variable, compartido in compartidos.items():
+                    contexto.run(variable.set, compartido)
+                vuelo = [None, 0, compartidos]
+                for variable, compartido in compartidos.items():
+                    compartido.agregar(espera, variable.get())
+                vuelo[0] = loop.create_task(fabrica(), context=contexto)
+                self._en_vuelo[clave_loop] = vuelo
+                vuelo[0].add_done_callback(lambda _: self._terminar(clave_loop, vuelo))
+                self.lideres += 1
+            else:
+                for variable, compartido in vuelo[2].items():
+                    compartido.agregar(espera, variable.get())
+                self.coalescidas += 1
+            vuelo[1] += 1
+
+        if not lider:
+            print(f"🔗 Análisis idéntico en curso, esperando su resultado ({clave[1][:32]})")
+
+        tarea = vuelo[0]
+        try:
+            # shield: cancelar una petición no cancela el análisis compartido
+            resultado = await asyncio.shield(tarea)
+        finally:
+            with self._lock:
+                vuelo[1] -= 1
+                for compartido in vuelo[2].values():
+                    compartido.quitar(espera)
+                abandonado = vuelo[1] == 0 and not tarea.done()
+            if abandonado:
+                tarea.cancel()
+
+        # Cada petición (también la primera) recibe su propia copia: el resultado de la tarea
+        # nunca sale de acá, así lo que una modifique (p. ej. la calibración) no le llega al resto
+        return copy.deepcopy(resultado)
+
+    def _terminar(self, clave_loop, vuelo):
+        with self._lock:
+            if self._en_vuelo.get(clave_loop) is vuelo:
+                del self._en_vuelo[clave_loop]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.lideres + self.coalescidas
+            return {
+                "ejecuciones": self.lideres,
+                "coalescidas": self.coalescidas,
+                "tasa_coalescencia": round(self.coalescidas / total, 4) if total else 0.0,
+                "en_vuelo": len(self._en_vuelo),
+            }
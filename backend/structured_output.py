@@ -0,0 +1,220 @@
+"""
+Salida estructurada del modelo de visión.
+
+Los esquemas Pydantic se envían como `response_format` (json_schema estricto)
+para que el modelo responda solo JSON válido. Si la respuesta igual trae texto
+alrededor (simulación, modelos sin soporte), `ExtractorJSON` la recorre una
+sola vez buscando el primer objeto JSON completo.
+"""
+
+import json
+from typing import Literal
+
+from pydantic import BaseModel, ConfigDict
+
+
+# Con json_schema estricto el modelo genera los campos en el orden en que se
+# declaran: el orden de cada esquema es el mismo que muestra el prompt, y en la
+# autocorrección integrada la revisión va antes del "peso" final.
+
+class AnalisisPeso(BaseModel):
+    """Respuesta del análisis Chain of Thought (mismos campos que pide el prompt)"""
+
+    model_config = ConfigDict(extra="forbid")
+
+    paso1_dimensiones: str
+    paso2_condicion: str
+    paso3_referencia_similar: str
+    paso4_peso_base: float
+    paso5_factor_condicion: float
+    paso6_peso_ajustado: float
+    paso7_ajuste_final: float
+    peso: int
+    condicion: Literal["delgada", "media", "buena", "excelente"]
+    confianza: Literal["alta", "media", "baja"]
+    observaciones: str
+    metodologia: str
+
+
+class AnalisisPesoAutocorregido(BaseModel):
+    """Análisis con la autocorrección integrada en la misma respuesta"""
+
+    model_config = ConfigDict(extra="forbid")
+
+    paso1_dimensiones: str
+    paso2_condicion: str
+    paso3_referencia_similar: str
+    paso4_peso_base: float
+    paso5_factor_condicion: float
+    paso6_peso_ajustado: float
+    paso7_ajuste_final: float
+    peso_inicial: int
+    peso_corregido: int
+    factor_correccion: str
+    peso: int
+    condicion: Literal["delgada", "media", "buena", "excelente"]
+    confianza: Literal["alta", "media", "baja"]
+    observaciones: str
+    metodologia: str
+
+
+class AnalisisPesoCompacto(BaseModel):
+    """Respuesta del prompt compacto (pasos razonados internamente)"""
+
+    model_config = ConfigDict(extra="forbid")
+
+    peso: int
+    condicion: Literal["delgada", "media", "buena", "excelente"]
+    confianza: Literal["alta", "media", "baja"]
+    observaciones: str
+
+
+class AnalisisPesoCompactoAutocorregido(BaseModel):
+    """Respuesta compacta con la autocorrección integrada"""
+
+    model_config = ConfigDict(extra="forbid")
+
+    peso_inicial: int
+    peso_corregido: int
+    factor_correccion: str
+    peso: int
+    condicion: Literal["delgada", "media", "buena", "excelente"]
+    confianza: Literal["alta", "media", "baja"]
+    observaciones: str
+
+
+class AutocorreccionPeso(BaseModel):
+    """Respuesta de la llamada de autocorrección"""
+
+    model_config = ConfigDict(extra="forbid")
+
+    peso_inicial: int
+    peso_corregido: int
+    factor_correccion: str
+    confianza_corregida: Literal["alta", "media", "baja"]
+    observaciones: str
+
+
+class ExtractorJSON:
+    """Escáner incremental de llaves: encuentra el primer objeto JSON completo en un texto
+
+    Recorre cada carácter una sola vez (respetando strings y escapes) y solo
+    intenta `json.loads` cuando un objeto de nivel superior se cierra. Se le
+    puede alimentar el texto de a partes, por ejemplo mientras llega en streaming.
+
+    Con `claves_suficientes` también acepta un objeto todavía abierto en cuanto
+    ya contiene esas claves completas (se evalúa en cada coma de primer nivel),
+    para poder cortar la generación sin esperar los campos restantes.
+    """
+
+    def __init__(self, clave_requerida: str = None, claves_suficientes: tuple = None):
+        self.clave_requerida = clave_requerida
+        self.claves_suficientes = claves_suficientes
+        self.resultado = None
+        self.parcial = False  # True si el resultado salió de un objeto aún no cerrado
+        self._texto = []
+        self._posicion = 0
+        self._inicio = None
+        self._profundidad = 0
+        self._en_string = False
+        self._escape = False
+        self._primer_objeto = None  # Primer objeto válido aunque no tenga la clave requerida
+
+    def alimentar(self, fragmento: str):
+        """Procesa un fragmento; devuelve el objeto encontrado o None si aún no hay uno completo"""
+        if self.resultado is not None:
+            return self.resultado
+
+        self._texto.append(fragmento)
+        for caracter in fragmento:
+            posicion = self._posicion
+            self._posicion += 1
+
+            if self._profundidad == 0:
+                # Fuera de un objeto solo importa dónde empieza el siguiente
+                if caracter == "{":
+                    self._inicio = posicion
+                    self._profundidad = 1
+                continue
+
+            if self._en_string:
+                if self._escape:
+                    self._escape = False
+                elif caracter == "\\":
+                    self._escape = True
+                elif caracter == '"':
+                    self._en_string = False
+            elif caracter == '"':
+                self._en_string = True
+            elif caracter == "{":
+                self._profundidad += 1
+            elif caracter == "," and self._profundidad == 1 and self.claves_suficientes:
+                if self._evaluar_parcial(self._inicio, posicion):
+                    return self.resultado
+            elif caracter == "}":
+                self._profundidad -= 1
+                if self._profundidad == 0 and self._evaluar(self._inicio, posicion + 1):
+                    return self.resultado
+        return None
+
+    def _evaluar(self, inicio, fin) -> bool:
+        texto = "".join(self._texto)
+        self._texto = [texto]
+        try:
+            objeto = json.loads(texto[inicio:fin])
+        except json.JSONDecodeError:
+            return False
+        if not isinstance(objeto, dict):
+            return False
+        if self.clave_requerida is None or self.clave_requerida in objeto:
+            self.resultado = objeto
+            return True
+        if self._primer_objeto is None:
+            self._primer_objeto = objeto
+        return False
+
+    def _evaluar_parcial(self, inicio, fin) -> bool:
+        """Cierra el objeto en la última coma y comprueba si ya tiene las claves suficientes"""
+        texto = "".join(self._texto)
+        self._texto = [texto]
+        try:
+            objeto = json.loads(texto[inicio:fin] + "}")
+        except json.JSONDecodeError:
+            return False
+        if isinstance(objeto, dict) and all(clave in objeto for clave in self.claves_suficientes):
+            self.resultado = objeto
+            self.parcial = True
+            return True
+        return False
+
+    def finalizar(self):
+        """Resultado final una vez recibido todo el texto"""
+        if self.resultado is not None:
+            return self.resultado
+        if self._profundidad > 0 and self._inicio is not None:
+            # Una llave suelta en el texto dejó el escáner desfasado: reintentar desde después de ella
+            resto = "".join(self._texto)[self._inicio + 1:]
+            extractor = ExtractorJSON(self.clave_requerida)
+            extractor.alimentar(resto)
+            encontrado = extractor.finalizar()
+            if encontrado is not None:
+                return encontrado
+        return self._primer_objeto
+
+
+def extraer_json(texto: str, clave_requerida: str = None):
+    """Primer objeto JSON del texto (con `clave_requerida` si se indica) o None"""
+    if not texto:
+        return None
+    contenido = texto.strip()
+    if contenido.startswith("{"):
+        # Salida estructurada: el contenido ya es el JSON
+        try:
+            objeto = json.loads(contenido)
+            if isinstance(objeto, dict):
+                return objeto
+        except json.JSONDecodeError:
+            pass
+    extractor = ExtractorJSON(clave_requerida)
+    extractor.alimentar(texto)
+    return extractor.finalizar()
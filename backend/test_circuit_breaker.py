@@ -0,0 +1,94 @@
+"""
+Pruebas del circuit breaker de la etapa del modelo (circuit_breaker.py)
+
+    python -m pytest test_circuit_breaker.py
+"""
+
+import time
+
+import pytest
+
+from circuit_breaker import ABIERTO, CERRADO, SEMIABIERTO, CircuitBreaker, CircuitoAbiertoError
+
+CONFIG = {
+    'ventana_segundos': 60,
+    'min_llamadas': 4,
+    'umbral_error_pct': 50,
+    'lenta_segundos': 5,
+    'umbral_lentas_pct': 80,
+    'abierto_segundos': 0.05,
+}
+
+
+def circuito_abierto():
+    circuito = CircuitBreaker("prueba", dict(CONFIG))
+    for _ in range(4):
+        circuito.admitir()
+        circuito.registrar(False, 0.1)
+    assert circuito.estado() == ABIERTO
+    return circuito
+
+
+def test_se_abre_por_tasa_de_errores():
+    circuito = CircuitBreaker("prueba", dict(CONFIG))
+    for exito in (True, True, False):
+        circuito.registrar(exito, 0.1)
+    assert circuito.estado() == CERRADO  # menos llamadas que el mínimo
+    circuito.registrar(False, 0.1)
+    assert circuito.estado() == ABIERTO
+    with pytest.raises(CircuitoAbiertoError):
+        circuito.admitir()
+    assert circuito.stats()['rechazadas'] == 1
+
+
+def test_se_abre_por_llamadas_lentas():
+    circuito = CircuitBreaker("prueba", dict(CONFIG))
+    for _ in range(4):
+        circuito.registrar(True, 6)
+    assert circuito.estado() == ABIERTO
+
+
+def test_la_sonda_exitosa_cierra_el_circuito():
+    circuito = circuito_abierto()
+    time.sleep(0.06)
+    assert circuito.estado() == SEMIABIERTO
+    assert circuito.admitir() is True
+    with pytest.raises(CircuitoAbiertoError):
+        circuito.admitir()  # una sola llamada de prueba a la vez
+    circuito.registrar(True, 0.1, es_sonda=True)
+    assert circuito.estado() == CERRADO
+    assert circuito.admitir() is False
+
+
+def test_la_sonda_fallida_vuelve_a_abrir():
+    circuito = circuito_abierto()
+    time.sleep(0.06)
+    assert circuito.admitir() is True
+    circuito.registrar(False, 0.1, es_sonda=True)
+    assert circuito.estado() == ABIERTO
+    assert circuito.aperturas == 2
+
+
+def test_una_llamada_tardia_no_decide_el_estado_semiabierto():
+    """Una llamada admitida con el circuito cerrado que termina en semiabierto no cuenta como sonda"""
+    circuito = circuito_abierto()
+    time.sleep(0.06)
+    assert circuito.admitir() is True  # sonda en curso
+
+    circuito.registrar(True, 0.1)  # tardía y exitosa: no cierra
+    assert circuito.estado() == SEMIABIERTO
+    circuito.registrar(False, 0.1)  # tardía y fallida: no reabre
+    assert circuito.estado() == SEMIABIERTO
+    with pytest.raises(CircuitoAbiertoError):
+        circuito.admitir()  # la sonda sigue en curso: no entra una segunda
+
+    circuito.registrar(True, 0.1, es_sonda=True)
+    assert circuito.estado() == CERRADO
+
+
+def test_liberar_sonda_permite_otra_prueba():
+    circuito = circuito_abierto()
+    time.sleep(0.06)
+    assert circuito.admitir() is True
+    circuito.liberar_sonda()  # la sonda se canceló antes de salir
+    assert circuito.admitir() is True
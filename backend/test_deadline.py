@@ -0,0 +1,103 @@
+"""
+Pruebas del plazo por petición (deadline.py)
+
+    python -m pytest test_deadline.py
+"""
+
+import asyncio
+import time
+
+import pytest
+
+import deadline
+from deadline import (
+    PLAZO_PETICION, PLAZOS_AGOTADOS, PlazoAgotadoError, con_plazo, esperar_con_plazo, limitar_timeout,
+    plazo, plazo_mas_holgado, plazo_vencido, tiempo_restante, verificar_plazo
+)
+from single_flight import SingleFlight
+
+
+def test_sin_plazo_no_hay_limite():
+    assert tiempo_restante() is None
+    assert limitar_timeout(None) is None
+    assert limitar_timeout(5) == 5
+    assert not plazo_vencido()
+
+
+def test_un_plazo_interno_no_extiende_el_externo():
+    with plazo(0.5):
+        with plazo(10):
+            assert tiempo_restante() <= 0.5
+        with plazo(0.1):
+            assert tiempo_restante() <= 0.1
+        assert 0.1 < tiempo_restante() <= 0.5
+        assert limitar_timeout(10) <= 0.5
+        assert limitar_timeout(0.01) == 0.01
+    assert tiempo_restante() is None
+
+
+def test_verificar_plazo_vencido_registra_la_etapa():
+    antes = PLAZOS_AGOTADOS.resumen().get("prueba", {}).get("n", 0)
+    with plazo(0):
+        assert plazo_vencido()
+        with pytest.raises(PlazoAgotadoError) as error:
+            verificar_plazo("prueba")
+    assert error.value.etapa == "prueba"
+    assert PLAZOS_AGOTADOS.resumen()["prueba"]["n"] == antes + 1
+
+
+def test_el_plazo_llega_a_los_hilos_y_a_los_decoradores():
+    @con_plazo(0.5)
+    async def endpoint():
+        return await asyncio.to_thread(tiempo_restante)
+
+    restante = asyncio.run(endpoint())
+    assert 0 < restante <= 0.5
+
+
+def test_esperar_con_plazo_corta_al_vencer():
+    async def principal():
+        with plazo(0.05):
+            inicio = time.monotonic()
+            with pytest.raises(asyncio.TimeoutError):
+                await esperar_con_plazo(asyncio.sleep(1))
+            return time.monotonic() - inicio
+
+    assert asyncio.run(principal()) < 0.5
+
+
+def test_esperar_con_plazo_respeta_el_timeout_propio_y_la_gracia():
+    async def principal():
+        assert await esperar_con_plazo(asyncio.sleep(0.01, "ok"), timeout=1) == "ok"
+        with pytest.raises(asyncio.TimeoutError):
+            await esperar_con_plazo(asyncio.sleep(1), timeout=0.02)
+        with plazo(0.01):
+            # La gracia deja recibir un resultado que llega poco después del plazo
+            return await esperar_con_plazo(asyncio.sleep(0.05, "tarde"), gracia=0.5)
+
+    assert asyncio.run(principal()) == "tarde"
+
+
+def test_plazo_mas_holgado():
+    assert plazo_mas_holgado([]) is None
+    assert plazo_mas_holgado([1.0, None]) is None
+    assert plazo_mas_holgado([1.0, 3.0, 2.0]) == 3.0
+
+
+def test_un_seguidor_con_mas_plazo_extiende_el_analisis_compartido(monkeypatch):
+    """El análisis compartido no se corta con el plazo corto de la primera petición"""
+    monkeypatch.setattr(deadline, "RELECTURA_PLAZO_SEGUNDOS", 0.01)
+    vuelo = SingleFlight(variables={PLAZO_PETICION: plazo_mas_holgado})
+
+    async def fabrica():
+        return await esperar_con_plazo(asyncio.sleep(0.2, "completo"))
+
+    async def peticion(segundos, demora):
+        await asyncio.sleep(demora)
+        with plazo(segundos):
+            return await vuelo.ejecutar("clave", fabrica)
+
+    async def principal():
+        return await asyncio.gather(peticion(0.05, 0), peticion(2, 0.01))
+
+    assert asyncio.run(principal()) == ["completo", "completo"]
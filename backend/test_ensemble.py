@@ -0,0 +1,67 @@
+"""
+Pruebas del ensemble concurrente (analyze_cow_image_with_multiple_attempts_async)
+
+    python -m pytest test_ensemble.py
+
+El modelo se reemplaza por una función local: no hace llamadas a OpenAI.
+"""
+
+import asyncio
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-test-key")
+os.environ.setdefault("PREDICTION_CACHE_ENABLED", "0")
+
+import pytest
+
+import langchain_utils_simulado as utils
+
+IMAGEN = os.path.join(os.path.dirname(__file__), "test_cow.jpg")
+
+
+@pytest.fixture
+def intentos(monkeypatch):
+    """Reemplaza cada intento del ensemble por uno simulado y mide la concurrencia"""
+    estado = {'en_curso': 0, 'maximo': 0, 'iniciados': 0, 'pesos': iter([470, 480, 490, 500, 510]), 'demora': 0.05}
+
+    async def intento_falso(ctx):
+        estado['iniciados'] += 1
+        estado['en_curso'] += 1
+        estado['maximo'] = max(estado['maximo'], estado['en_curso'])
+        try:
+            await asyncio.sleep(estado['demora'])
+            return {'peso': next(estado['pesos']), 'confianza': 'alta'}
+        finally:
+            estado['en_curso'] -= 1
+
+    monkeypatch.setattr(utils, "combine_openai_and_dataset_analysis_async", intento_falso)
+    return estado
+
+
+def test_los_intentos_corren_en_paralelo_con_tope(intentos):
+    resultado = asyncio.run(utils.analyze_cow_image_with_multiple_attempts_async(
+        IMAGEN, attempts=5, max_concurrencia=2, timeout=5, modo="paralelo"
+    ))
+    assert intentos['iniciados'] == 5
+    assert intentos['maximo'] == 2
+    assert resultado['intentos_usados'] == 5
+    assert 470 <= resultado['peso'] <= 510
+
+
+def test_el_timeout_cancela_los_pendientes_y_usa_los_terminados(intentos):
+    intentos['demora'] = 0.2
+    resultado = asyncio.run(utils.analyze_cow_image_with_multiple_attempts_async(
+        IMAGEN, attempts=4, max_concurrencia=2, timeout=0.3, modo="paralelo"
+    ))
+    # Los dos primeros terminaron; los otros dos se cancelaron a mitad de camino
+    assert intentos['iniciados'] == 4
+    assert intentos['en_curso'] == 0
+    assert resultado is not None and resultado['peso'] in (470, 480, 475)
+
+
+def test_sin_intentos_terminados_no_hay_consenso(intentos):
+    intentos['demora'] = 1
+    resultado = asyncio.run(utils.analyze_cow_image_with_multiple_attempts_async(
+        IMAGEN, attempts=2, max_concurrencia=2, timeout=0.05, modo="paralelo"
+    ))
+    assert resultado is None
@@ -0,0 +1,102 @@
+"""
+Pruebas de las peticiones con cobertura (hedging.py)
+
+    python -m pytest test_hedging.py
+"""
+
+import asyncio
+
+from hedging import HedgingLLM
+
+CONFIG = {'activo': True, 'percentil': 90, 'presupuesto_pct': 100, 'min_muestras': 5}
+
+
+def con_muestras(latencia=0.05, config=None):
+    hedging = HedgingLLM(dict(config or CONFIG))
+    for _ in range(50):
+        hedging._registrar_latencia("n1", latencia)
+    return hedging
+
+
+def test_sin_muestras_suficientes_no_hay_cobertura():
+    hedging = HedgingLLM(dict(CONFIG))
+    llamadas = []
+
+    async def fabrica():
+        llamadas.append(1)
+        await asyncio.sleep(0.02)
+        return "ok"
+
+    assert asyncio.run(hedging.ejecutar(fabrica, clave="n1")) == "ok"
+    assert hedging.umbral("n1") is None
+    assert len(llamadas) == 1 and hedging.coberturas == 0
+
+
+def test_gana_la_cobertura_y_se_cancela_la_original():
+    hedging = con_muestras()
+    canceladas = []
+    demoras = iter([1.0, 0.01])  # la original se cuelga, la cobertura responde enseguida
+
+    async def fabrica():
+        demora = next(demoras)
+        try:
+            await asyncio.sleep(demora)
+        except asyncio.CancelledError:
+            canceladas.append(demora)
+            raise
+        return demora
+
+    async def principal():
+        resultado = await hedging.ejecutar(fabrica, clave="n1")
+        await asyncio.sleep(0)
+        return resultado
+
+    assert asyncio.run(principal()) == 0.01
+    assert canceladas == [1.0]
+    assert hedging.coberturas == 1 and hedging.ganadas_por_cobertura == 1
+
+
+def test_la_latencia_se_mide_desde_el_envio_original():
+    """Si gana la cobertura, la muestra no puede ser solo lo que tardó la cobertura"""
+    hedging = con_muestras()
+    demoras = iter([1.0, 0.01])
+
+    async def fabrica():
+        await asyncio.sleep(next(demoras))
+        return "ok"
+
+    asyncio.run(hedging.ejecutar(fabrica, clave="n1"))
+    ultima = hedging._latencias["n1"][-1]
+    assert ultima >= 0.05 + 0.01  # umbral (p90 de 0.05 s) + lo que tardó la cobertura
+
+
+def test_el_presupuesto_limita_las_coberturas():
+    hedging = con_muestras(config=dict(CONFIG, presupuesto_pct=50))
+
+    async def fabrica():
+        await asyncio.sleep(0.1)
+        return "ok"
+
+    async def principal():
+        for _ in range(4):
+            await hedging.ejecutar(fabrica, clave="n1")
+
+    asyncio.run(principal())
+    # Con 50% de presupuesto: una cobertura cada dos llamadas como máximo
+    assert hedging.coberturas == 2
+    assert hedging.stats()['tasa_cobertura'] == 0.5
+
+
+def test_si_la_original_falla_se_espera_la_cobertura():
+    hedging = con_muestras()
+    intentos = iter(["falla", "ok"])
+
+    async def fabrica():
+        intento = next(intentos)
+        if intento == "falla":
+            await asyncio.sleep(0.1)
+            raise RuntimeError("error del proveedor")
+        await asyncio.sleep(0.2)
+        return intento
+
+    assert asyncio.run(hedging.ejecutar(fabrica, clave="n1")) == "ok"
@@ -0,0 +1,83 @@
+"""
+Pruebas del almacén de trabajos en segundo plano (job_store.py)
+
+    python -m pytest test_job_store.py
+"""
+
+import numpy as np
+
+from job_store import COMPLETADO, ERROR, JOBS_CONFIG, PENDIENTE, PROCESANDO, JobStore
+
+
+def nuevo_store(tmp_path, **config):
+    return JobStore(str(tmp_path / "jobs.sqlite3"), dict(JOBS_CONFIG, **config))
+
+
+def test_ciclo_completo_de_un_trabajo(tmp_path):
+    store = nuevo_store(tmp_path)
+    job_id = store.crear(imagen=b"bytes", nombre="vaca.jpg")
+    assert store.obtener(job_id)['estado'] == PENDIENTE
+    assert store.obtener(job_id)['posicion_en_cola'] == 1
+
+    trabajo = store.tomar("worker-1")
+    assert trabajo['id'] == job_id and trabajo['imagen'] == b"bytes" and trabajo['intentos'] == 1
+    assert store.obtener(job_id)['estado'] == PROCESANDO
+    assert store.tomar("worker-2") is None
+
+    store.completar(job_id, {"peso": np.int64(480), "confianza": "alta"})
+    trabajo = store.obtener(job_id)
+    assert trabajo['estado'] == COMPLETADO
+    assert trabajo['resultado'] == {"peso": 480, "confianza": "alta"}
+    assert store.stats()['completados'] == 1
+
+
+def test_se_toma_el_pendiente_mas_antiguo(tmp_path):
+    store = nuevo_store(tmp_path)
+    primero = store.crear(url="https://ejemplo.com/1.jpg")
+    segundo = store.crear(url="https://ejemplo.com/2.jpg")
+    assert store.obtener(segundo)['posicion_en_cola'] == 2
+    assert store.tomar("w")['id'] == primero
+    assert store.tomar("w")['id'] == segundo
+
+
+def test_dos_procesos_no_toman_el_mismo_trabajo(tmp_path):
+    """Dos conexiones al mismo archivo (API y worker aparte) se reparten los trabajos"""
+    api = nuevo_store(tmp_path)
+    worker = nuevo_store(tmp_path)
+    ids = {api.crear(imagen=b"x") for _ in range(4)}
+    tomados = [api.tomar("a"), worker.tomar("b"), api.tomar("a"), worker.tomar("b")]
+    assert {t['id'] for t in tomados} == ids
+    assert api.tomar("a") is None
+
+
+def test_reencolar_no_cuenta_el_intento(tmp_path):
+    store = nuevo_store(tmp_path)
+    job_id = store.crear(imagen=b"x")
+    store.tomar("w")
+    store.reencolar(job_id, "Modelo saturado")
+    trabajo = store.obtener(job_id)
+    assert trabajo['estado'] == PENDIENTE and trabajo['intentos'] == 0
+    assert store.tomar("w")['intentos'] == 1
+
+
+def test_huerfanos_vuelven_a_la_cola_hasta_agotar_intentos(tmp_path):
+    store = nuevo_store(tmp_path, huerfano_segundos=0, max_intentos=2)
+    job_id = store.crear(imagen=b"x")
+    assert store.tomar("caido")['intentos'] == 1
+    # El worker murió: otro lo recupera al tomar
+    assert store.tomar("otro")['intentos'] == 2
+    # Agotó los intentos: queda con error en lugar de volver a la cola
+    assert store.tomar("tercero") is None
+    trabajo = store.obtener(job_id)
+    assert trabajo['estado'] == ERROR and "intentos" in trabajo['error']
+
+
+def test_purgar_elimina_solo_los_terminados_viejos(tmp_path):
+    store = nuevo_store(tmp_path, retencion_horas=0)
+    terminado = store.crear(imagen=b"x")
+    store.tomar("w")
+    store.fallar(terminado, "RuntimeError: falla")
+    pendiente = store.crear(imagen=b"y")
+    assert store.purgar() == 1
+    assert store.obtener(terminado) is None
+    assert store.obtener(pendiente)['estado'] == PENDIENTE
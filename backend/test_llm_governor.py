@@ -0,0 +1,112 @@
+"""
+Pruebas del gobernador de llamadas al modelo (llm_governor.py)
+
+    python -m pytest test_llm_governor.py
+"""
+
+import asyncio
+import threading
+
+import pytest
+
+from llm_governor import GobernadorLLM, LLMSaturadoError, TokenBucket
+
+CONFIG = {
+    'max_concurrencia': 2,
+    'peticiones_por_minuto': 0,
+    'tokens_por_minuto': 0,
+    'max_en_cola': 32,
+    'max_reintentos': 0,
+    'backoff_base_segundos': 0.01,
+    'backoff_max_segundos': 0.01,
+}
+
+
+def test_el_limite_de_concurrencia_vale_para_todo_el_proceso():
+    """Varios event loops (wrappers síncronos en hilos) comparten el mismo cupo"""
+    gobernador = GobernadorLLM(dict(CONFIG))
+    lock = threading.Lock()
+    en_vuelo = [0]
+    maximo = [0]
+
+    async def llamada():
+        with lock:
+            en_vuelo[0] += 1
+            maximo[0] = max(maximo[0], en_vuelo[0])
+        await asyncio.sleep(0.02)
+        with lock:
+            en_vuelo[0] -= 1
+        return "ok"
+
+    def script():
+        async def principal():
+            return await asyncio.gather(*[gobernador.ejecutar(llamada) for _ in range(4)])
+        assert asyncio.run(principal()) == ["ok"] * 4
+
+    hilos = [threading.Thread(target=script) for _ in range(3)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert maximo[0] == 2
+    assert gobernador.stats()['llamadas'] == 12
+    assert gobernador.stats()['en_vuelo'] == 0
+
+
+def test_cancelar_mientras_espera_el_cupo_lo_deja_libre():
+    gobernador = GobernadorLLM(dict(CONFIG, max_concurrencia=1))
+
+    async def principal():
+        ocupada = asyncio.create_task(gobernador.ejecutar(lambda: asyncio.sleep(0.05)))
+        await asyncio.sleep(0.01)
+        esperando = asyncio.create_task(gobernador.ejecutar(lambda: asyncio.sleep(0)))
+        await asyncio.sleep(0.01)
+        esperando.cancel()
+        await ocupada
+        # El cupo no quedó tomado por la llamada cancelada
+        return await asyncio.wait_for(gobernador.ejecutar(lambda: asyncio.sleep(0, "ok")), 1)
+
+    assert asyncio.run(principal()) == "ok"
+    assert gobernador._cupo.en_uso == 0
+
+
+def test_rechaza_cuando_la_cola_esta_llena():
+    gobernador = GobernadorLLM(dict(CONFIG, max_concurrencia=1, max_en_cola=1))
+
+    async def principal():
+        primera = asyncio.create_task(gobernador.ejecutar(lambda: asyncio.sleep(0.05)))
+        await asyncio.sleep(0.01)
+        segunda = asyncio.create_task(gobernador.ejecutar(lambda: asyncio.sleep(0)))
+        await asyncio.sleep(0.01)
+        with pytest.raises(LLMSaturadoError) as error:
+            await gobernador.ejecutar(lambda: asyncio.sleep(0))
+        await asyncio.gather(primera, segunda)
+        return error.value
+
+    error = asyncio.run(principal())
+    assert error.retry_after >= 1
+    assert gobernador.stats()['rechazadas'] == 1
+
+
+def test_la_reserva_de_tokens_se_devuelve_si_se_cancela_antes_de_enviar():
+    gobernador = GobernadorLLM(dict(CONFIG, tokens_por_minuto=6000))
+
+    async def principal():
+        await gobernador.ejecutar(lambda: asyncio.sleep(0), tokens_estimados=6000)  # agota la cubeta
+        esperando = asyncio.create_task(gobernador.ejecutar(lambda: asyncio.sleep(0), tokens_estimados=3000))
+        await asyncio.sleep(0.01)
+        esperando.cancel()
+        await asyncio.gather(esperando, return_exceptions=True)
+
+    asyncio.run(principal())
+    # Sin la devolución quedaría en -3000 (más la recarga de unos milisegundos)
+    assert gobernador.tokens.disponibles > -100
+
+
+def test_token_bucket_espera_proporcional_al_faltante():
+    cubeta = TokenBucket(60)
+    assert cubeta.reservar(60) == 0.0
+    assert cubeta.reservar(30) == pytest.approx(30, abs=0.1)
+    cubeta.devolver(30)
+    assert cubeta.disponibles == pytest.approx(0, abs=0.1)
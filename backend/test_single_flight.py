@@ -0,0 +1,125 @@
+"""
+Pruebas de la coalescencia de peticiones idénticas (single_flight.py)
+
+    python -m pytest test_single_flight.py
+"""
+
+import asyncio
+import contextvars
+
+from single_flight import SingleFlight, valor_actual
+
+VARIABLE = contextvars.ContextVar("variable_prueba", default=None)
+
+
+def test_peticiones_identicas_comparten_una_ejecucion():
+    """Cinco peticiones simultáneas con la misma clave ejecutan la fábrica una sola vez"""
+    vuelo = SingleFlight()
+    llamadas = []
+
+    async def fabrica():
+        llamadas.append(1)
+        await asyncio.sleep(0.05)
+        return {"peso": 480}
+
+    async def principal():
+        return await asyncio.gather(*[vuelo.ejecutar(("sha256", "abc"), fabrica) for _ in range(5)])
+
+    resultados = asyncio.run(principal())
+    assert len(llamadas) == 1
+    assert [r["peso"] for r in resultados] == [480] * 5
+    assert vuelo.stats()["coalescidas"] == 4
+    assert vuelo.stats()["en_vuelo"] == 0
+
+
+def test_el_lider_no_contamina_a_los_seguidores():
+    """Si la primera petición modifica su resultado (calibración), las demás no lo ven"""
+    vuelo = SingleFlight()
+
+    async def fabrica():
+        await asyncio.sleep(0.05)
+        return {"peso": 480, "detalle": {"calibrado": False}}
+
+    async def lider():
+        resultado = await vuelo.ejecutar(("sha256", "abc"), fabrica)
+        resultado["peso"] = 512
+        resultado["detalle"]["calibrado"] = True
+        return resultado
+
+    async def seguidor():
+        await asyncio.sleep(0.01)
+        resultado = await vuelo.ejecutar(("sha256", "abc"), fabrica)
+        await asyncio.sleep(0)  # deja correr al líder primero
+        return resultado
+
+    async def principal():
+        return await asyncio.gather(lider(), seguidor(), seguidor())
+
+    calibrado, *seguidores = asyncio.run(principal())
+    assert calibrado == {"peso": 512, "detalle": {"calibrado": True}}
+    for resultado in seguidores:
+        assert resultado == {"peso": 480, "detalle": {"calibrado": False}}
+
+
+def test_cancelar_una_peticion_no_cancela_el_analisis():
+    vuelo = SingleFlight()
+
+    async def fabrica():
+        await asyncio.sleep(0.05)
+        return {"peso": 480}
+
+    async def principal():
+        primera = asyncio.create_task(vuelo.ejecutar("clave", fabrica))
+        segunda = asyncio.create_task(vuelo.ejecutar("clave", fabrica))
+        await asyncio.sleep(0.01)
+        primera.cancel()
+        return await segunda, primera.cancelled()
+
+    resultado, cancelada = asyncio.run(principal())
+    assert resultado == {"peso": 480}
+    assert cancelada
+
+
+def test_se_cancela_si_todas_las_peticiones_se_van():
+    vuelo = SingleFlight()
+    terminada = []
+
+    async def fabrica():
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            terminada.append("cancelada")
+            raise
+
+    async def principal():
+        peticion = asyncio.create_task(vuelo.ejecutar("clave", fabrica))
+        await asyncio.sleep(0.01)
+        peticion.cancel()
+        await asyncio.sleep(0.01)
+
+    asyncio.run(principal())
+    assert terminada == ["cancelada"]
+    assert vuelo.stats()["en_vuelo"] == 0
+
+
+def test_la_ejecucion_combina_los_valores_de_todas_las_peticiones():
+    """La tarea compartida corre en un contexto neutro con el valor combinado de quienes esperan"""
+    vuelo = SingleFlight(variables={VARIABLE: lambda valores: sorted(v for v in valores if v is not None)})
+    vistos = []
+
+    async def fabrica():
+        vistos.append(valor_actual(VARIABLE))
+        await asyncio.sleep(0.05)
+        vistos.append(valor_actual(VARIABLE))
+        return None
+
+    async def peticion(valor, demora):
+        await asyncio.sleep(demora)
+        VARIABLE.set(valor)
+        await vuelo.ejecutar("clave", fabrica)
+
+    async def principal():
+        await asyncio.gather(peticion("a", 0), peticion("b", 0.01))
+
+    asyncio.run(principal())
+    assert vistos == [["a"], ["a", "b"]]
@@ -0,0 +1,161 @@
+"""
+Límite de tamaño para las imágenes subidas.
+
+El middleware corta la petición con 413 apenas el cuerpo recibido supera el
+límite (o si Content-Length ya lo declara), sin esperar a que termine la
+subida. Las rutas de la app usan `RutaUploadLimitado`: cada archivo se corta
+con 413 en cuanto supera MAX_FILE_SIZE y se mantiene en memoria, así que una
+subida válida nunca pasa por un archivo temporal. Los lotes usan
+`leer_form_limitado(..., en_memoria=False)` para que sus archivos pasen a disco
+y la memoria no crezca con el tamaño del lote.
+"""
+
+import os
+
+from fastapi import HTTPException, Request, UploadFile
+from fastapi.routing import APIRoute
+from starlette.formparsers import MultiPartException, MultiPartParser
+from starlette.responses import JSONResponse
+
+# Tamaño máximo de imagen aceptado
+MAX_FILE_SIZE = int(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024
+# Tamaño máximo del cuerpo completo de un lote de imágenes (cada imagen sigue limitada a MAX_FILE_SIZE)
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_UPLOAD_MB", "300")) * 1024 * 1024
+# Rutas que aceptan varios archivos por petición
+LIMITES_POR_RUTA = {"/predict-batch": MAX_BATCH_SIZE}
+# Holgura para los encabezados y separadores del multipart
+MARGEN_MULTIPART = 64 * 1024
+# Tamaño de bloque al leer el archivo subido
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _detalle_413(max_bytes: int) -> str:
+    return f"El archivo es demasiado grande. Máximo permitido: {max_bytes // (1024 * 1024)}MB"
+
+
+class LimiteUploadMiddleware:
+    """Middleware ASGI que rechaza con 413 los cuerpos más grandes que el límite"""
+
+    def __init__(self, app, max_bytes: int = MAX_FILE_SIZE, limites_por_ruta: dict = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.limites_por_ruta = LIMITES_POR_RUTA if limites_por_ruta is None else limites_por_ruta
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT"):
+            await self.app(scope, receive, send)
+            return
+
+        max_bytes = self.limites_por_ruta.get(scope["path"], self.max_bytes)
+        limite = max_bytes + MARGEN_MULTIPART
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limite:
+            print(f"🚫 Subida rechazada por Content-Length: {int(content_length)} bytes")
+            respuesta = JSONResponse({"detail": _detalle_413(max_bytes)}, status_code=413)
+            await respuesta(scope, receive, send)
+            return
+
+        recibidos = 0
+
+        async def receive_limitado():
+            nonlocal recibidos
+            message = await receive()
+            if message["type"] == "http.request":
+                recibidos += len(message.get("body", b""))
+                if recibidos > limite:
+                    # Cuerpo sin Content-Length (chunked) o con uno falso: cortar ya
+                    print(f"🚫 Subida cortada tras {recibidos} bytes")
+                    raise HTTPException(status_code=413, detail=_detalle_413(max_bytes))
+            return message
+
+        await self.app(scope, receive_limitado, send)
+
+
+async def leer_upload_limitado(file: UploadFile, max_bytes: int = MAX_FILE_SIZE) -> bytes:
+    """Lee el archivo subido por bloques, con 413 en cuanto supera `max_bytes`"""
+    if file.size and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=_detalle_413(max_bytes))
+
+    buffer = bytearray()
+    while True:
+        bloque = await file.read(UPLOAD_CHUNK_SIZE)
+        if not bloque:
+            break
+        buffer += bloque
+        if len(buffer) > max_bytes:
+            raise HTTPException(status_code=413, detail=_detalle_413(max_bytes))
+    return bytes(buffer)
+
+
+class ArchivoDemasiadoGrandeError(MultiPartException):
+    """Un archivo del multipart superó el tope por archivo"""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(_detalle_413(max_bytes))
+
+
+class MultiPartParserLimitado(MultiPartParser):
+    """Parser multipart con tope de bytes por archivo y tamaño de spool propio (sin tocar el de Starlette)"""
+
+    def __init__(self, *args, max_bytes_archivo: int = MAX_FILE_SIZE, spool_max_size: int = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_bytes_archivo = max_bytes_archivo
+        if spool_max_size is not None:
+            self.spool_max_size = spool_max_size  # Atributo de la instancia, no de la clase
+        self._bytes_archivo = 0
+
+    def on_part_begin(self) -> None:
+        super().on_part_begin()
+        self._bytes_archivo = 0
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._current_part.file is not None:
+            self._bytes_archivo += end - start
+            if self._bytes_archivo > self.max_bytes_archivo:
+                raise ArchivoDemasiadoGrandeError(self.max_bytes_archivo)
+        super().on_part_data(data, start, end)
+
+
+async def leer_form_limitado(request: Request, en_memoria: bool = True, max_files: int = 1000,
+                             max_bytes_archivo: int = MAX_FILE_SIZE):
+    """Form multipart de la petición con 413 por archivo; `en_memoria=False` deja que los archivos pasen a disco"""
+    parser = MultiPartParserLimitado(
+        request.headers,
+        request.stream(),
+        max_files=max_files,
+        max_bytes_archivo=max_bytes_archivo,
+        spool_max_size=max_bytes_archivo + MARGEN_MULTIPART if en_memoria else None,
+    )
+    try:
+        return await parser.parse()
+    except ArchivoDemasiadoGrandeError as e:
+        print(f"🚫 Archivo cortado al superar {max_bytes_archivo} bytes")
+        raise HTTPException(status_code=413, detail=e.message)
+    except MultiPartException as e:
+        raise HTTPException(status_code=400, detail=e.message)
+
+
+class RequestUploadLimitado(Request):
+    """Request cuyo form() usa MultiPartParserLimitado (archivos en memoria hasta MAX_FILE_SIZE)"""
+
+    async def form(self, **kwargs):
+        formulario = getattr(self, "_form_limitado", None)
+        if formulario is None:
+            if self.headers.get("content-type", "").startswith("multipart/form-data"):
+                formulario = await leer_form_limitado(self, max_files=kwargs.get("max_files", 1000))
+            else:
+                formulario = await super().form(**kwargs)
+            self._form_limitado = formulario
+        return formulario
+
+
+class RutaUploadLimitado(APIRoute):
+    """Ruta de FastAPI que entrega a los endpoints un RequestUploadLimitado"""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def handler_limitado(request: Request):
+            return await handler(RequestUploadLimitado(request.scope, request.receive))
+
+        return handler_limitado